@@ -0,0 +1,157 @@
+import argparse
+import json
+import logging
+import sys
+import tempfile
+
+import pandas as pd
+
+import ptvflows_pipeline as pipeline
+from ptvflows_synthetic import MockPtvServer, SyntheticKpis, add_synthetic_arguments
+
+# End-to-end benchmark of the pipeline against the synthetic mock server: times every
+# stage of the Data Fetch path (run_pipeline, with and without the historical stats
+# cache) and the per-KPI metrics of the KPI Analysis page, over several repeats. A list
+# of KPI counts sweeps them to show how the wall-clock time scales with the tenant size.
+#   python ptvflows_benchmark.py --kpis 200 --history-hours 168 --json after.json --baseline before.json
+#   python ptvflows_benchmark.py --kpis 50,200,800
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_API_KEY = "benchmark"
+
+# Total milliseconds per stage of one run
+def stage_totals(recorder):
+    if not recorder.spans:
+        return pd.Series(dtype='float64')
+    return recorder.summary()['total_ms']
+
+# Memory of the comparison before and after its projection, as kept per session, in bytes
+def comparison_memory(recorder):
+    for span in recorder.spans:
+        if span.name == "compare.project":
+            return span.attributes.get('bytes_before'), span.attributes.get('bytes')
+    return None, None
+
+# One run of the Data Fetch path followed by the metrics of every KPI; returns the stage
+# totals and the comparison memory
+def run_once(args, cache_root=None):
+    recorder = pipeline.PerfRecorder()
+    cache = None
+    if cache_root is not None:
+        cache = pipeline.HistoricalStatsCache(BENCHMARK_API_KEY, root=cache_root)
+    with pipeline.perf_span(recorder, "pipeline"):
+        result = pipeline.run_pipeline(
+            BENCHMARK_API_KEY, max_workers=args.max_concurrent, rate_limit=args.rate_limit, cache=cache,
+            recorder=recorder
+        )
+    comparison, comparison_index = result['comparison'], result['comparison_index']
+    if comparison is not None:
+        with pipeline.perf_span(recorder, "analysis.calculate_metrics", kpis=len(comparison_index)):
+            for kpi_name in comparison_index:
+                pipeline.calculate_metrics(pipeline.get_kpi_data(comparison, comparison_index, kpi_name))
+    return stage_totals(recorder), comparison_memory(recorder)
+
+# Min, median and max of the stage totals over the repeats for n_kpis KPIs, per scenario
+# and stage, and the comparison memory of the last run
+def run_benchmark_kpis(args, n_kpis):
+    kpis = SyntheticKpis(n_kpis, args.history_hours, args.progressives, args.seed)
+    server = MockPtvServer(kpis, fail_rate=args.fail_rate, latency=args.latency_ms / 1000).start()
+    pipeline.set_api_root(server.api_root)
+    runs = []
+    memory = (None, None)
+    try:
+        for repeat in range(args.repeat):
+            totals, memory = run_once(args)
+            runs.append(totals.rename(('no cache', repeat)))
+            with tempfile.TemporaryDirectory() as cache_root:
+                for scenario in ('cold cache', 'warm cache'):
+                    totals, memory = run_once(args, cache_root)
+                    runs.append(totals.rename((scenario, repeat)))
+            logger.info(f"{n_kpis} KPIs: repeat {repeat + 1}/{args.repeat} done")
+    finally:
+        server.shutdown()
+        server.server_close()
+    totals = pd.concat(runs, axis=1).T
+    totals.index = pd.MultiIndex.from_tuples(totals.index, names=['scenario', 'repeat'])
+    stats = totals.groupby(level='scenario').agg(['min', 'median', 'max']).stack(level=0, future_stack=True)
+    stats.index.names = ['scenario', 'stage']
+    return stats.dropna(how='all').sort_index(), memory
+
+# Stage statistics of every KPI count of args.kpis, indexed by kpis, scenario and stage,
+# and the comparison memory per KPI count
+def run_benchmark(args):
+    stats = {}
+    memory = {}
+    for n_kpis in args.kpis:
+        stats[n_kpis], memory[n_kpis] = run_benchmark_kpis(args, n_kpis)
+    stats = pd.concat(stats, names=['kpis'])
+    return stats, memory
+
+# Wall-clock scaling with the KPI count: median time of the whole pipeline per scenario,
+# in total and per KPI
+def scaling_table(stats):
+    pipeline_ms = stats['median'].xs('pipeline', level='stage').unstack('scenario')
+    per_kpi_ms = pipeline_ms.div(pipeline_ms.index.to_series(), axis=0)
+    return pd.concat({'total ms': pipeline_ms, 'ms per KPI': per_kpi_ms}, axis=1)
+
+# Median ratio against a previous --json result, and the stages slower than threshold
+def compare_with_baseline(stats, baseline, threshold, min_ms):
+    previous = pd.DataFrame(baseline['stages']).set_index(['kpis', 'scenario', 'stage'])['median']
+    ratio = (stats['median'] / previous).rename('ratio')
+    regressions = ratio[(ratio > threshold) & (previous.reindex(ratio.index) >= min_ms)]
+    return ratio, regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the PTV Flows pipeline against a synthetic mock API.")
+    add_synthetic_arguments(parser, kpi_sweep=True)
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per scenario")
+    parser.add_argument('--max-concurrent', type=int, default=pipeline.DEFAULT_MAX_WORKERS)
+    parser.add_argument('--rate-limit', type=float, default=1000.0, help="Requests per second (default: unthrottled)")
+    parser.add_argument('--json', dest='json_path', help="Write the results as JSON, to be used as a later --baseline")
+    parser.add_argument('--baseline', help="JSON results of a previous run to compare the medians with")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="Exit with status 1 when a stage median exceeds the baseline by this factor")
+    parser.add_argument('--min-ms', type=float, default=5.0, help="Ignore baseline stages faster than this")
+    parser.add_argument('--log-level', default='WARNING', type=str.upper)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    pipeline.configure_logging(args.log_level)
+    stats, memory = run_benchmark(args)
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            ratio, regressions = compare_with_baseline(stats, json.load(f), args.threshold, args.min_ms)
+        stats = stats.join(ratio)
+        if not regressions.empty:
+            status = 1
+    with pd.option_context('display.max_rows', None, 'display.width', 160, 'display.float_format', '{:.1f}'.format):
+        print(f"{', '.join(map(str, args.kpis))} KPIs, {args.history_hours} h history, {args.progressives} progressives, "
+              f"{args.repeat} repeats; stage totals in ms")
+        print(stats)
+        if len(args.kpis) > 1:
+            print("Pipeline wall-clock scaling with the KPI count (median):")
+            print(scaling_table(stats))
+    for n_kpis, (memory_before, memory_after) in memory.items():
+        if memory_after is not None:
+            print(f"Comparison memory per session at {n_kpis} KPIs: {memory_before / 2**20:.2f} MiB before "
+                  f"projection, {memory_after / 2**20:.2f} MiB after ({memory_after / memory_before:.0%})")
+    if status:
+        print(f"Slower than {args.threshold:.2f}x the baseline: "
+              f"{', '.join(' / '.join(map(str, key)) for key in regressions.index)}")
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({
+                'config': vars(args),
+                'stages': stats.reset_index().to_dict('records'),
+                'comparison_memory': [
+                    {'kpis': n_kpis, 'before_bytes': memory_before, 'after_bytes': memory_after}
+                    for n_kpis, (memory_before, memory_after) in memory.items()
+                ],
+            }, f, indent=2)
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1346 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import ijson
+except ImportError:  # Optional: historical responses are then parsed in one go
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+# Fetch -> group -> compare -> metrics pipeline of the PTV Flows data analysis, without
+# any Streamlit dependency. Used by streamlit_app.py and runnable as a batch CLI:
+#   python ptvflows_pipeline.py --api-key KEY [--api-key KEY2 ...] --output-dir out
+
+
+# Define the base URLs for the different API endpoints. $PTVFLOWS_API_ROOT points them at
+# another server, e.g. the mock server of ptvflows_synthetic.py
+BASEURL = "api.myptv.com"
+API_ROOT = os.environ.get("PTVFLOWS_API_ROOT", f"https://{BASEURL}").rstrip("/")
+KPI_ENG_URL = f"{API_ROOT}/kpieng/v1/instance/all"
+KPI_HISTORICAL_URL = f"{API_ROOT}/kpistats/v1/historical/result/by-kpi-id"
+KPI_24HOURS_URL = f"{API_ROOT}/kpieng/v1/result/by-kpi-id"
+
+# Default number of concurrent requests used when fetching per-KPI data
+DEFAULT_MAX_WORKERS = 16
+
+# Rate limit shared by all requests of a fetch, as requests per second and burst size
+DEFAULT_RATE_LIMIT = 20.0
+DEFAULT_RATE_BURST = 20
+# Throttled (429) and unavailable (5xx) responses are retried with exponential backoff
+# and full jitter, honoring Retry-After; KPIs still failing are queued for further rounds
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+RETRY_AFTER_MAX_SECONDS = 120.0
+KPI_RETRY_ROUNDS = 2
+# Seconds to wait for a connection and between bytes of a response, unless a request sets
+# its own timeout; a stalled request times out and is retried like a dropped one
+REQUEST_TIMEOUT_SECONDS = (10, 60)
+
+# Local on-disk cache of historical stats, partitioned by API key, kpiId and day
+HIST_CACHE_DIR = os.environ.get("PTVFLOWS_CACHE_DIR", ".ptvflows_cache")
+DEFAULT_CACHE_RETENTION_DAYS = 30
+
+# Chunk size used when streaming large historical responses
+HIST_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Columns parsed as timestamps and value columns stored as float32 when assembling frames
+TIMESTAMP_COLUMNS = ['timeStamp', 'RoundedTimeStamp']
+VALUE_COLUMNS = ['overallResult.value', 'defaultValue', 'value', 'averageValue', 'unusualValue']
+
+# Historical value columns averaged per progressive and summed per 5-minute bucket
+HIST_VALUE_COLUMNS = ['defaultValue', 'value', 'averageValue', 'unusualValue']
+# Largest range of the packed grouping keys, per historical row, counted directly rather
+# than hashed when grouping
+DENSE_KEYS_PER_ROW = 4
+
+# Columns of the comparison kept for analysis and their dtypes, in order; None keeps the
+# dtype and 'integer' downcasts to the smallest integer type holding the values (int8
+# for the progressives)
+COMPARISON_SCHEMA = {
+    'kpiId': 'category',
+    'name': 'category',
+    'ForecastedTimestamp': None,
+    'progressive': 'integer',
+    'overallResult.value': 'float32',
+    'value': 'float32',
+    'AbsDelta': 'float32',
+    'ErrorPerc': 'float32',
+}
+
+# Columns of the comparison exported by the CLI, as COMPARISON_SCHEMA plus the times of
+# the forecast and of the matched history, the timetostart and the unit. The timestamps
+# suffixed by the merge of forecasts and history are first renamed by REPORT_RENAMES
+REPORT_RENAMES = {
+    'timeStamp_x': 'timeStamp',
+    'RoundedTimeStamp_x': 'RoundedTimeStamp',
+    'timeStamp_y': 'historicalTimeStamp',
+}
+REPORT_SCHEMA = {
+    'kpiId': 'category',
+    'name': 'category',
+    'timeStamp': None,
+    'RoundedTimeStamp': None,
+    'timetostart': 'integer',
+    'ForecastedTimestamp': None,
+    'historicalTimeStamp': None,
+    'progressive': 'integer',
+    'overallResult.value': 'float32',
+    'overallResult.unit': 'category',
+    'value': 'float32',
+    'averageValue': 'float32',
+    'defaultValue': 'float32',
+    'unusualValue': 'float32',
+    'AbsDelta': 'float32',
+    'ErrorPerc': 'float32',
+}
+
+# Largest gap, in minutes, between the time a forecast targets and the historical bucket
+# it is matched with when measuring accuracy per horizon
+ACCURACY_TOLERANCE_MINUTES = 5
+
+# Minimum seconds between two partial results published by a RefreshWorker
+PUBLISH_INTERVAL_SECONDS = 2.0
+
+# Log level of the app and the CLI, overridden by --log-level
+DEFAULT_LOG_LEVEL = os.environ.get("PTVFLOWS_LOG_LEVEL", "INFO")
+
+# Configure logging at the given level name (default: DEFAULT_LOG_LEVEL). HTTP client
+# libraries stay at WARNING unless DEBUG is asked for, as they log every request
+def configure_logging(level=None):
+    level = (level or DEFAULT_LOG_LEVEL).upper()
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger().setLevel(level)
+    logging.getLogger("urllib3").setLevel(level if level == "DEBUG" else logging.WARNING)
+
+# A timed span of work. Attributes such as rows and bytes are added with set()
+class Span:
+    def __init__(self, name, trace_id=None, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "OK"
+
+    @property
+    def duration_ms(self):
+        return (self.end_ns - self.start_ns) / 1e6 if self.end_ns is not None else None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+# Thread-safe recorder of the spans of a run. Spans opened in the same thread nest;
+# spans opened in worker threads name their parent explicitly
+class PerfRecorder:
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def span(self, name, parent=None, **attributes):
+        stack = self._local.__dict__.setdefault("stack", [])
+        if parent is None and stack:
+            parent = stack[-1]
+        span = Span(name, self.trace_id, parent.span_id if parent is not None else None, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "ERROR"
+            span.set(error=str(e))
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+            logger.debug(f"{name} took {span.duration_ms:.1f} ms {span.attributes}")
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+        self.trace_id = uuid.uuid4().hex
+
+    # One row per span, in start order
+    def to_frame(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start_ns)
+        return pd.DataFrame({
+            'name': [span.name for span in spans],
+            'start': pd.to_datetime([span.start_ns for span in spans], utc=True),
+            'duration_ms': [span.duration_ms for span in spans],
+            'rows': [span.attributes.get('rows') for span in spans],
+            'bytes': [span.attributes.get('bytes') for span in spans],
+            'status': [span.status for span in spans],
+        }, columns=['name', 'start', 'duration_ms', 'rows', 'bytes', 'status'])
+
+    # Count, latency and volume per span name, slowest total first
+    def summary(self):
+        spans = self.to_frame()
+        summary = spans.groupby('name').agg(
+            count=('duration_ms', 'size'),
+            total_ms=('duration_ms', 'sum'),
+            mean_ms=('duration_ms', 'mean'),
+            max_ms=('duration_ms', 'max'),
+            rows=('rows', 'sum'),
+            bytes=('bytes', 'sum'),
+            errors=('status', lambda status: int((status == 'ERROR').sum())),
+        )
+        return summary.sort_values('total_ms', ascending=False)
+
+    # Spans in the OpenTelemetry OTLP/JSON layout
+    def to_otel(self, service_name="ptvflows"):
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {'key': key, 'value': {'boolValue': value}}
+            if isinstance(value, (int, np.integer)):
+                return {'key': key, 'value': {'intValue': str(value)}}
+            if isinstance(value, (float, np.floating)):
+                return {'key': key, 'value': {'doubleValue': float(value)}}
+            return {'key': key, 'value': {'stringValue': str(value)}}
+
+        with self._lock:
+            spans = list(self.spans)
+        return {'resourceSpans': [{
+            'resource': {'attributes': [attribute('service.name', service_name)]},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': [{
+                    'traceId': span.trace_id,
+                    'spanId': span.span_id,
+                    'parentSpanId': span.parent_id or '',
+                    'name': span.name,
+                    'startTimeUnixNano': str(span.start_ns),
+                    'endTimeUnixNano': str(span.end_ns),
+                    'attributes': [attribute(key, value) for key, value in span.attributes.items()],
+                    'status': {'code': 2 if span.status == 'ERROR' else 1},
+                } for span in spans],
+            }],
+        }]}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_otel(), **kwargs)
+
+# Span of the given recorder, or an unrecorded one when recorder is None
+def perf_span(recorder, name, parent=None, **attributes):
+    if recorder is None:
+        return nullcontext(Span(name, attributes=attributes))
+    return recorder.span(name, parent=parent, **attributes)
+
+# Point the API endpoints at another root URL, e.g. "http://127.0.0.1:8080"
+def set_api_root(api_root):
+    global API_ROOT, KPI_ENG_URL, KPI_HISTORICAL_URL, KPI_24HOURS_URL
+    API_ROOT = api_root.rstrip("/")
+    KPI_ENG_URL = f"{API_ROOT}/kpieng/v1/instance/all"
+    KPI_HISTORICAL_URL = f"{API_ROOT}/kpistats/v1/historical/result/by-kpi-id"
+    KPI_24HOURS_URL = f"{API_ROOT}/kpieng/v1/result/by-kpi-id"
+
+# Define headers for the API requests
+def get_headers(api_key):
+    return {
+        "apiKey": api_key,
+        "Accept": "*/*",
+        "Connection": "keep-alive"
+    }
+
+# Short stable identifier of a tenant, derived from its API key without exposing it
+def tenant_key(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+# Short stable identifier of a set of KPIs, whatever their order
+def kpi_set_key(kpi_ids):
+    return hashlib.sha256("\n".join(sorted(kpi_ids)).encode("utf-8")).hexdigest()[:16]
+
+# Token bucket shared by the fetch workers: acquire() blocks until a request may be sent
+class TokenBucket:
+    def __init__(self, rate=DEFAULT_RATE_LIMIT, burst=DEFAULT_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+# Exponential backoff with full jitter for the given retry attempt (0-based)
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+# Seconds to wait according to the Retry-After header (delay in seconds or HTTP date), if any
+def retry_after_delay(response):
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        delay = (retry_at - datetime.now(retry_at.tzinfo)).total_seconds()
+    return min(max(delay, 0.0), RETRY_AFTER_MAX_SECONDS)
+
+# Session that rate limits every request and retries throttled, unavailable and dropped
+# requests; the last response is returned once the retries are exhausted. Requests time
+# out after timeout seconds unless they set their own
+class ThrottledSession(requests.Session):
+    def __init__(self, rate_limiter=None, max_retries=MAX_RETRIES, recorder=None, timeout=REQUEST_TIMEOUT_SECONDS):
+        super().__init__()
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.recorder = recorder
+        self.timeout = timeout
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with perf_span(self.recorder, "http.request", method=method, url=url.split("?")[0]) as span:
+            for attempt in range(self.max_retries + 1):
+                span.set(attempts=attempt + 1)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                try:
+                    response = super().request(method, url, *args, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = backoff_delay(attempt)
+                    logger.warning(f"Request to {url} failed ({e}), retrying in {delay:.1f}s")
+                else:
+                    if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                        span.set(status_code=response.status_code)
+                        return response
+                    delay = retry_after_delay(response)
+                    if delay is None:
+                        delay = backoff_delay(attempt)
+                    response.close()
+                    logger.warning(f"Request to {url} returned {response.status_code}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+# Create a pooled keep-alive session shared by all fetch workers, rate limited to
+# rate_limit requests per second; requests are timed into recorder, if given. The burst
+# lets every worker start at once, but never more requests than one second's worth
+def create_session(api_key, max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, recorder=None):
+    burst = max(1, min(max(DEFAULT_RATE_BURST, max_workers), int(rate_limit)))
+    session = ThrottledSession(TokenBucket(rate_limit, burst), recorder=recorder)
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(get_headers(api_key))
+    return session
+
+def extract_timetostart(param_dict):
+    try:
+        return param_dict.get('parameters', {}).get('timetostart', None)
+    except AttributeError:
+        return None
+
+# Fetch the KPI definitions of a tenant; raises requests.RequestException on failure
+def fetch_kpi_definitions(api_key, recorder=None):
+    logger.info("Fetching all KPI definitions...")
+    with perf_span(recorder, "fetch.kpi_definitions") as span:
+        with create_session(api_key, 1, recorder=recorder) as session:
+            response = session.get(KPI_ENG_URL)
+        response.raise_for_status()  # Raise an exception if the response status code is not 200
+        kpi_data = response.json()
+        kpi_df = pd.DataFrame(kpi_data)
+        kpi_df['timetostart'] = kpi_df['kpiInstanceParameters'].apply(extract_timetostart)
+        span.set(rows=len(kpi_df), bytes=len(response.content))
+    logger.info(f"Fetched {len(kpi_df)} KPIs.")
+    logger.debug(f"KPI definitions head:\n{kpi_df.head()}")
+    return kpi_df
+
+# Fetch last 24 hours data for a specific KPI
+def fetch_last_24_hours_data(kpi_id, session):
+    logger.debug(f"Fetching last 24 hours data for KPI: {kpi_id}")
+    url = f"{KPI_24HOURS_URL}?kpiId={kpi_id}"
+    with perf_span(getattr(session, 'recorder', None), "fetch.last_24_hours", kpiId=kpi_id) as span:
+        response = session.get(url)
+        if response.status_code in RETRY_STATUS_CODES:
+            # Still throttled or unavailable after the session retries: let the caller queue the KPI again
+            response.raise_for_status()
+        if response.status_code == 200:
+            data = response.json()
+            df = pd.json_normalize(data)
+            if 'timeStamp' in df.columns:
+                df['RoundedTimeStamp'] = round_to_nearest_5min(df['timeStamp'])
+            df['kpiId'] = kpi_id  # Ensure 'kpiId' is in the DataFrame
+            df = compact_frame(df, drop_columns=['results'])
+            span.set(rows=len(df), bytes=len(response.content))
+            logger.debug(f"Fetched last 24 hours data for KPI: {kpi_id}")
+            return df
+        else:
+            logger.warning(f"Failed to fetch data for KPI: {kpi_id}, Status Code: {response.status_code}, Response: {response.text}")
+    return pd.DataFrame()
+
+# Fetch historical stats for a specific KPI
+def fetch_historical_stats(kpi_id, session):
+    logger.debug(f"Fetching historical stats for KPI: {kpi_id}")
+    url = f"{KPI_HISTORICAL_URL}?kpiId={kpi_id}"
+    with perf_span(getattr(session, 'recorder', None), "fetch.historical", kpiId=kpi_id) as span:
+        response = session.get(url, stream=True)
+        with response:
+            if response.status_code in RETRY_STATUS_CODES:
+                # Still throttled or unavailable after the session retries: let the caller queue the KPI again
+                response.raise_for_status()
+            if response.status_code == 200:
+                df = pd.DataFrame(historical_columns(iter_historical_entries(response)))
+                if 'timeStamp' in df.columns:
+                    df['kpiId'] = kpi_id
+                    df['RoundedTimeStamp'] = round_to_nearest_5min(df['timeStamp'])
+                    df = compact_frame(df)
+                # Bytes pulled over the wire, as the body was streamed
+                span.set(rows=len(df), bytes=response.raw.tell())
+                logger.debug(f"Fetched historical stats for KPI: {kpi_id}")
+                return df
+            else:
+                logger.warning(f"Failed to fetch historical stats for KPI: {kpi_id}, Status Code: {response.status_code}, Response: {response.text}")
+    return pd.DataFrame()
+
+# File-like view over a streamed response body, as expected by ijson
+class ResponseReader:
+    def __init__(self, response, chunk_size=HIST_STREAM_CHUNK_SIZE):
+        self._chunks = response.iter_content(chunk_size)
+
+    def read(self, size=-1):
+        if size == 0:
+            return b""
+        return next(self._chunks, b"")
+
+# Yield the top-level entries of a historical response one at a time when ijson is
+# available, so only one entry is materialized as Python objects at once
+def iter_historical_entries(response):
+    if ijson is None:
+        yield from response.json()
+        return
+    try:
+        yield from ijson.items(ResponseReader(response), 'item', use_float=True)
+    except ijson.JSONError as e:
+        raise requests.exceptions.InvalidJSONError(f"Invalid historical stats response: {e}")
+
+# Flatten the nested 'results' of each entry directly into column lists, adding the
+# entry 'timeStamp' to each result; results missing a field get None for it
+def historical_columns(entries):
+    columns = {}
+    timestamps = []
+    for entry in entries:
+        if 'timeStamp' in entry and 'results' in entry:
+            timestamp = entry['timeStamp']
+            for result in entry['results']:
+                row = len(timestamps)
+                for key, value in result.items():
+                    if key in ('timeStamp', 'kpiId'):
+                        continue
+                    column = columns.get(key)
+                    if column is None:
+                        column = columns[key] = [None] * row
+                    column.append(value)
+                timestamps.append(timestamp)
+                for column in columns.values():
+                    if len(column) < len(timestamps):
+                        column.append(None)
+    if timestamps:
+        columns['timeStamp'] = timestamps
+    return columns
+
+# Write path atomically: write(f) fills a uniquely named temporary file in the same
+# directory, which is then renamed over path, so readers and concurrent writers never
+# see a partial file
+def write_atomically(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# Parquet cache of historical stats. Past 5-minute buckets never change, so each
+# KPI keeps its raw results in one file per day plus the last 'timeStamp' held;
+# a refresh only appends results newer than that timestamp. Files are replaced
+# atomically and the writers of a KPI are serialized within the process, as
+# sessions sharing a tenant, or a cancelled refresh and its replacement, may merge
+# the same KPI at once.
+class HistoricalStatsCache:
+    _kpi_locks = {}
+    _kpi_locks_lock = threading.Lock()
+
+    def __init__(self, api_key, root=HIST_CACHE_DIR, retention_days=DEFAULT_CACHE_RETENTION_DAYS):
+        self.root = os.path.join(root, tenant_key(api_key))
+        self.retention_days = retention_days
+
+    def _kpi_dir(self, kpi_id):
+        return os.path.join(self.root, quote(str(kpi_id), safe=""))
+
+    # Lock of a KPI directory, shared by all the caches of the process
+    def _kpi_lock(self, kpi_id):
+        kpi_dir = os.path.abspath(self._kpi_dir(kpi_id))
+        with self._kpi_locks_lock:
+            return self._kpi_locks.setdefault(kpi_dir, threading.Lock())
+
+    def _cutoff(self):
+        return pd.Timestamp.now(tz="UTC").normalize() - pd.Timedelta(days=self.retention_days)
+
+    def last_timestamp(self, kpi_id):
+        try:
+            with open(os.path.join(self._kpi_dir(kpi_id), "meta.json")) as f:
+                return pd.Timestamp(json.load(f)["last_timestamp"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    # True when the newest closed 5-minute bucket is already cached
+    def is_fresh(self, kpi_id):
+        last_timestamp = self.last_timestamp(kpi_id)
+        if last_timestamp is None:
+            return False
+        return last_timestamp >= pd.Timestamp.now(tz="UTC").floor("5min") - pd.Timedelta(minutes=5)
+
+    def load(self, kpi_id):
+        kpi_dir = self._kpi_dir(kpi_id)
+        if not os.path.isdir(kpi_dir):
+            return pd.DataFrame()
+        cutoff_day = self._cutoff().strftime("%Y-%m-%d")
+        frames = [
+            pd.read_parquet(os.path.join(kpi_dir, name))
+            for name in sorted(os.listdir(kpi_dir))
+            if name.endswith(".parquet") and name[:-len(".parquet")] >= cutoff_day
+        ]
+        return compact_frame(pd.concat(frames, ignore_index=True)) if frames else pd.DataFrame()
+
+    # Append the results newer than the cached last timestamp and return the full cached history
+    def merge(self, kpi_id, df):
+        if df.empty or 'timeStamp' not in df.columns:
+            return self.load(kpi_id)
+        df = compact_frame(df)
+        timestamps = df['timeStamp']
+        with self._kpi_lock(kpi_id):
+            last_timestamp = self.last_timestamp(kpi_id)
+            keep = timestamps >= self._cutoff()
+            if last_timestamp is not None:
+                keep &= timestamps > last_timestamp
+            new_rows = df[keep]
+            if not new_rows.empty:
+                kpi_dir = self._kpi_dir(kpi_id)
+                os.makedirs(kpi_dir, exist_ok=True)
+                days = timestamps[keep].dt.strftime("%Y-%m-%d")
+                for day, day_rows in new_rows.groupby(days.to_numpy()):
+                    path = os.path.join(kpi_dir, f"{day}.parquet")
+                    if os.path.exists(path):
+                        day_rows = pd.concat([compact_frame(pd.read_parquet(path)), day_rows], ignore_index=True)
+                    write_atomically(path, lambda f: day_rows.to_parquet(f, index=False))
+                meta = json.dumps({"last_timestamp": timestamps[keep].max().isoformat()})
+                write_atomically(os.path.join(kpi_dir, "meta.json"), lambda f: f.write(meta.encode("utf-8")))
+        return self.load(kpi_id)
+
+    # Drop day partitions older than the retention period and KPIs that are no longer defined
+    def evict(self, keep_kpi_ids=None):
+        if not os.path.isdir(self.root):
+            return
+        keep_dirs = None if keep_kpi_ids is None else {os.path.basename(self._kpi_dir(kpi_id)) for kpi_id in keep_kpi_ids}
+        cutoff_day = self._cutoff().strftime("%Y-%m-%d")
+        for kpi_dir_name in os.listdir(self.root):
+            kpi_dir = os.path.join(self.root, kpi_dir_name)
+            if keep_dirs is not None and kpi_dir_name not in keep_dirs:
+                shutil.rmtree(kpi_dir, ignore_errors=True)
+                continue
+            for name in os.listdir(kpi_dir):
+                if name.endswith(".parquet") and name[:-len(".parquet")] < cutoff_day:
+                    os.remove(os.path.join(kpi_dir, name))
+
+# Fetch historical stats through the local cache: the API is only hit when a newer
+# 5-minute bucket may exist, and only results newer than the cached ones are stored
+def fetch_historical_stats_cached(kpi_id, session, cache=None):
+    if cache is None:
+        return fetch_historical_stats(kpi_id, session)
+    if cache.is_fresh(kpi_id):
+        logger.debug(f"Using cached historical stats for KPI: {kpi_id}")
+        with perf_span(getattr(session, 'recorder', None), "cache.load", kpiId=kpi_id) as span:
+            df = cache.load(kpi_id)
+            span.set(rows=len(df))
+        return df
+    return cache.merge(kpi_id, fetch_historical_stats(kpi_id, session))
+
+# Fetch last 24 hours data and historical stats for all KPIs concurrently.
+# Results are returned in the order of kpi_ids, followed by a dict of the KPIs that could
+# not be fetched after KPI_RETRY_ROUNDS further rounds, mapped to their last error;
+# progress(message) is called from the calling thread after each completed request, and
+# on_result(kind, kpi_id, frame) after each successful one, kind being 'last_24_hours' or
+# 'historical'. Setting the stop event abandons the requests not started yet; KPIs left
+# without data then get empty frames.
+def fetch_all_kpi_data(kpi_ids, api_key, max_workers=DEFAULT_MAX_WORKERS, progress=None, cache=None,
+                       fetch_last_24_hours=fetch_last_24_hours_data, fetch_historical=fetch_historical_stats_cached,
+                       rate_limit=DEFAULT_RATE_LIMIT, recorder=None, on_result=None, stop=None):
+    kpi_ids = list(kpi_ids)
+    last_24_hours_frames = {}
+    historical_frames = {}
+    errors = {}
+    pending = []
+    for kpi_id in kpi_ids:
+        pending.append((fetch_last_24_hours, (), last_24_hours_frames, kpi_id))
+        pending.append((fetch_historical, (cache,), historical_frames, kpi_id))
+    kinds = {id(last_24_hours_frames): 'last_24_hours', id(historical_frames): 'historical'}
+    total = len(pending)
+    completed = 0
+    with create_session(api_key, max_workers, rate_limit, recorder) as session, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            perf_span(recorder, "fetch.all_kpis", kpis=len(kpi_ids)) as fetch_span:
+        def run(fetch, kpi_id, *args):
+            # Worker threads do not inherit the span stack: nest their spans explicitly
+            with perf_span(recorder, "fetch.task", parent=fetch_span, kpiId=kpi_id):
+                return fetch(kpi_id, session, *args)
+
+        for retry_round in range(KPI_RETRY_ROUNDS + 1):
+            if stop is not None and stop.is_set():
+                break
+            if retry_round > 0:
+                logger.warning(f"Retrying {len(pending)} failed requests (round {retry_round}/{KPI_RETRY_ROUNDS})")
+                time.sleep(backoff_delay(retry_round))
+            futures = {executor.submit(run, fetch, kpi_id, *args): (fetch, args, frames, kpi_id)
+                       for fetch, args, frames, kpi_id in pending}
+            pending = []
+            for future in as_completed(futures):
+                if stop is not None and stop.is_set():
+                    for other in futures:
+                        other.cancel()
+                fetch, args, frames, kpi_id = futures[future]
+                if future.cancelled():
+                    continue
+                try:
+                    frames[kpi_id] = future.result()
+                    completed += 1
+                    if on_result is not None:
+                        on_result(kinds[id(frames)], kpi_id, frames[kpi_id])
+                except (requests.RequestException, OSError) as e:
+                    logger.warning(f"Error fetching data for KPI: {kpi_id}: {e}")
+                    errors[kpi_id] = str(e)
+                    pending.append(futures[future])
+                if progress is not None:
+                    progress(f"Fetched {completed}/{total} requests (last KPI ID: {kpi_id})")
+            if not pending:
+                break
+        fetch_span.set(failed=len(pending))
+    failed = {}
+    for fetch, args, frames, kpi_id in pending:
+        frames[kpi_id] = pd.DataFrame()
+        failed[kpi_id] = errors[kpi_id]
+    return (
+        [last_24_hours_frames.get(kpi_id, pd.DataFrame()) for kpi_id in kpi_ids],
+        [historical_frames.get(kpi_id, pd.DataFrame()) for kpi_id in kpi_ids],
+        failed,
+    )
+
+# Set explicit dtypes on the frame of one KPI, without drop_columns: categorical kpiId,
+# UTC datetime64 timestamps and float32 values. Applied to every fetched frame, so the
+# frames kept per KPI are compact; columns already converted are left as they are
+def compact_frame(df, drop_columns=()):
+    drop_columns = [column for column in drop_columns if column in df.columns]
+    if drop_columns:
+        df = df.drop(columns=drop_columns)
+    dtypes = df.dtypes
+    converted = {}
+    if 'kpiId' in dtypes and not isinstance(dtypes['kpiId'], pd.CategoricalDtype):
+        converted['kpiId'] = df['kpiId'].astype('category')
+    for column in TIMESTAMP_COLUMNS:
+        if column in dtypes and not is_utc(dtypes[column]):
+            converted[column] = to_utc(df[column], format='ISO8601')
+    for column in VALUE_COLUMNS:
+        if column in dtypes and dtypes[column] != np.float32:
+            converted[column] = pd.to_numeric(df[column], errors='coerce').astype('float32')
+    return df.assign(**converted) if converted else df
+
+# Build one frame from the per-KPI frames in a single pass, converting each frame with
+# compact_frame() first so the raw object columns are never concatenated
+def assemble_frames(frames, drop_columns=()):
+    frames = [compact_frame(df, drop_columns) for df in frames if df is not None and not df.empty]
+    if not frames:
+        return pd.DataFrame()
+    if not all('kpiId' in df.columns for df in frames):
+        df = pd.concat(frames, ignore_index=True)
+        if 'kpiId' in df.columns:
+            df['kpiId'] = df['kpiId'].astype('category')
+        return df
+    # Recode every kpiId on the union of the categories, so the columns are concatenated as
+    # categoricals of one dtype instead of being materialized as strings
+    kpi_ids = [df['kpiId'].array for df in frames]
+    categories = pd.Index(np.concatenate([ids.categories.to_numpy() for ids in kpi_ids])).unique().sort_values()
+    dtype = pd.CategoricalDtype(categories)
+    frames = [
+        df.assign(kpiId=pd.Categorical.from_codes(
+            np.where(ids.codes >= 0, categories.get_indexer(ids.categories)[ids.codes], -1), dtype=dtype
+        ))
+        for df, ids in zip(frames, kpi_ids)
+    ]
+    return pd.concat(frames, ignore_index=True)
+
+# Round a column of ISO timestamps down to their 5-minute bucket (UTC)
+def round_to_nearest_5min(timestamps):
+    return pd.to_datetime(timestamps, utc=True, format='ISO8601').dt.floor('5min')
+
+# Shift a column of rounded timestamps by 'timetostart' seconds; missing offsets give NaT
+def compute_forecasted_timestamp(rounded_timestamps, timetostart):
+    return rounded_timestamps + pd.to_timedelta(pd.to_numeric(timetostart, errors='coerce'), unit='s')
+
+
+# Codes of a grouping key in the sorted order of its values, and the values: categories
+# keep their codes, integers of a small range (counted in steps of step) are offset from
+# their minimum and other values are factorized
+def key_codes(values, step=1):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy().astype(np.int64), values.cat.categories
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.integer):
+        low, high = int(values.min()), int(values.max())
+        if (high - low) // step < len(values):
+            offsets = values.astype(np.int64) - low
+            if step == 1 or not (offsets % step).any():
+                return offsets // step, np.arange(low, high + 1, step, dtype=values.dtype)
+    codes, uniques = pd.factorize(values, sort=True)
+    return codes.astype(np.int64), uniques
+
+# Whether a dtype is that of UTC datetimes
+def is_utc(dtype):
+    return isinstance(dtype, pd.DatetimeTZDtype) and str(dtype.tz) == 'UTC'
+
+# Timestamps as UTC datetimes, converting only the columns that are not yet timezone-aware
+def to_utc(timestamps, **kwargs):
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        return timestamps.dt.tz_convert('UTC')
+    return pd.to_datetime(timestamps, utc=True, **kwargs)
+
+# Reduce the historical results to one row per ('kpiId', 'RoundedTimeStamp') in a single
+# pass over the rows: value columns are averaged per 'progressive' and the averages summed
+# per bucket, 'progressive' and 'timeStamp' take their maximum. Equivalent to grouping by
+# ['kpiId', 'RoundedTimeStamp', 'progressive'] with a mean and then by
+# ['kpiId', 'RoundedTimeStamp'] with a sum, without sorting the rows.
+def group_historical_data(historical_stats_data):
+    key_columns = ['kpiId', 'RoundedTimeStamp', 'progressive']
+    columns = key_columns[:2] + HIST_VALUE_COLUMNS + ['progressive', 'timeStamp']
+    if historical_stats_data.empty or any(column not in historical_stats_data.columns for column in key_columns):
+        return pd.DataFrame(columns=columns)
+    df = historical_stats_data.dropna(subset=key_columns)
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+
+    # Encode the three keys as one integer, ordered by kpiId, then bucket, then progressive
+    kpi_codes, kpi_uniques = key_codes(df['kpiId'])
+    # Buckets are counted in steps of 5 minutes from the earliest one
+    rounded = to_utc(df['RoundedTimeStamp'])
+    rounded_codes, rounded_uniques = key_codes(
+        rounded.to_numpy(dtype=f'datetime64[{rounded.dt.unit}]').view('i8'),
+        step=int(pd.Timedelta(minutes=5) / pd.Timedelta(1, unit=rounded.dt.unit))
+    )
+    progressive_codes, progressive_uniques = key_codes(df['progressive'])
+    n_rounded, n_progressives = len(rounded_uniques), len(progressive_uniques)
+    keys = (kpi_codes * n_rounded + rounded_codes) * n_progressives + progressive_codes
+
+    # Group ids per (kpiId, bucket, progressive) in key order. When the key range is small
+    # compared with the rows, as when the KPIs share their buckets, the keys are counted
+    # directly instead of being hashed
+    n_keys = len(kpi_uniques) * n_rounded * n_progressives
+    if n_keys <= DENSE_KEYS_PER_ROW * len(keys):
+        present = np.bincount(keys, minlength=n_keys) > 0
+        group_keys = np.flatnonzero(present)
+        group_codes = (np.cumsum(present) - 1)[keys]
+    else:
+        group_codes, group_keys = pd.factorize(keys, sort=True)
+    # Group ids per (kpiId, bucket), also in key order
+    bucket_keys = group_keys // n_progressives
+    new_bucket = np.ones(len(group_keys), dtype=bool)
+    new_bucket[1:] = bucket_keys[1:] != bucket_keys[:-1]
+    group_buckets = np.cumsum(new_bucket) - 1
+    bucket_keys = bucket_keys[new_bucket]
+    n_groups, n_buckets = len(group_keys), len(bucket_keys)
+
+    if isinstance(df['kpiId'].dtype, pd.CategoricalDtype):
+        kpi_ids = pd.Series(pd.Categorical.from_codes(bucket_keys // n_rounded, dtype=df['kpiId'].dtype))
+    else:
+        kpi_ids = pd.Series(kpi_uniques.take(bucket_keys // n_rounded)).astype(df['kpiId'].dtype)
+    grouped = {
+        'kpiId': kpi_ids,
+        'RoundedTimeStamp': utc_series(rounded_uniques.take(bucket_keys % n_rounded), rounded.dtype),
+    }
+    value_columns = [column for column in HIST_VALUE_COLUMNS if column in df.columns]
+    # The sum of the group means of a bucket is the sum of its values, each divided by the
+    # number of values in its group: one weighted count per column, with no division at
+    # all when every group holds a single row
+    row_buckets = group_buckets[group_codes]
+    group_sizes = None if n_groups == len(keys) else np.bincount(group_codes, minlength=n_groups)
+    for column in value_columns:
+        values = df[column].to_numpy(dtype='float64', na_value=np.nan)
+        valid = ~np.isnan(values)
+        counts = group_sizes
+        if not valid.all():
+            values = np.where(valid, values, 0.0)
+            if group_sizes is not None:
+                counts = np.bincount(group_codes, weights=valid, minlength=n_groups)
+        if counts is not None:
+            row_counts = counts[group_codes]
+            values = np.divide(values, row_counts, out=np.zeros_like(values), where=row_counts > 0)
+        grouped[column] = pd.Series(np.bincount(row_buckets, weights=values, minlength=n_buckets)).astype(df[column].dtype)
+    # Groups are in key order, so the last group of each bucket holds the highest progressive
+    last_groups = np.append(np.flatnonzero(new_bucket)[1:], n_groups) - 1
+    grouped['progressive'] = pd.Series(progressive_uniques.take(group_keys[last_groups] % n_progressives)).astype(df['progressive'].dtype)
+    if 'timeStamp' in df.columns:
+        timestamps = to_utc(df['timeStamp'], format='ISO8601')
+        latest = np.full(n_buckets, np.iinfo(np.int64).min)
+        np.maximum.at(latest, row_buckets,
+                      timestamps.to_numpy(dtype=f'datetime64[{timestamps.dt.unit}]').view('i8'))
+        grouped['timeStamp'] = utc_series(latest, timestamps.dtype)
+    return pd.DataFrame(grouped, columns=[column for column in columns if column in grouped])
+
+# Build a UTC datetime Series of the given dtype from naive datetime64 values, or int64
+# counts since the epoch, in the unit of dtype
+def utc_series(values, dtype):
+    return pd.Series(np.asarray(values).view(f'datetime64[{dtype.unit}]')).dt.tz_localize('UTC').astype(dtype)
+
+# Join the forecasts with the grouped historical data on the forecasted 5-minute bucket
+# and progressive, and compute the absolute and percentage errors
+def compare_forecasts(last_24_hours_data, groupedHistoricalData, kpi_names):
+    if last_24_hours_data.empty or groupedHistoricalData.empty:
+        return None
+    logger.info("Comparing forecasted data with historical data...")
+    # Perform inner join on 'kpiId' and 'ForecastedTimestamp' from merged_data with 'kpiId' and 'RoundedTimeStamp' from groupedHistoricalData
+    comparison = pd.merge(
+        last_24_hours_data, 
+        groupedHistoricalData, 
+        left_on=['kpiId', 'ForecastedTimestamp', 'overallResult.progressive'], 
+        right_on=['kpiId', 'RoundedTimeStamp', 'progressive'], 
+        how='inner'
+    )
+    comparison['AbsDelta'] = (comparison['overallResult.value'] - comparison['value']).abs()
+    comparison['ErrorPerc'] = (comparison['AbsDelta'] / comparison['value']) * 100
+    # Merge to include 'name' from kpi_ids_df in comparison
+    comparison = pd.merge(comparison, kpi_names, on='kpiId', how='left')
+    logger.debug(f"Comparison results:\n{comparison.head()}")
+    return comparison
+
+# Keep only the columns of schema, in its order and with its dtypes, dropping the other
+# columns of the merged forecasts and history (duplicated keys, raw timestamps, ...)
+def project_comparison(comparison, schema=COMPARISON_SCHEMA):
+    projected = {}
+    for column, dtype in schema.items():
+        if column not in comparison.columns:
+            continue
+        values = comparison[column]
+        if dtype == 'integer':
+            values = pd.to_numeric(values, downcast='integer')
+        elif dtype is not None:
+            values = values.astype(dtype)
+        projected[column] = values
+    return pd.DataFrame(projected, index=comparison.index)
+
+# Deep memory usage of a frame in bytes
+def frame_memory(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+# Assemble the last 24 hours data of all KPIs and add the 'ForecastedTimestamp' each
+# forecast refers to, using the 'timetostart' of its KPI instance
+def prepare_last_24_hours_data(last_24_hours_frames, kpi_ids_df):
+    last_24_hours_data = assemble_frames(last_24_hours_frames, drop_columns=['results'])
+    if last_24_hours_data.empty:
+        return last_24_hours_data
+    logger.debug(f"Columns in last_24_hours_data: {last_24_hours_data.columns.tolist()}")
+    # Merge to include 'timetostart' in last_24_hours_data
+    merged_data = last_24_hours_data.merge(kpi_ids_df[['kpiId', 'timetostart']], on='kpiId', how='left')
+    merged_data['ForecastedTimestamp'] = compute_forecasted_timestamp(
+        merged_data['RoundedTimeStamp'], merged_data['timetostart']
+    )
+    return merged_data
+
+# Sort the comparison by KPI name and record the row range of each KPI, so selecting a
+# KPI is a positional slice instead of a boolean scan over every KPI
+def build_comparison_index(comparison):
+    comparison = comparison.sort_values(['name', 'ForecastedTimestamp'], kind='stable').reset_index(drop=True)
+    positions = comparison.groupby('name', sort=False, observed=True).indices
+    comparison_index = {name: (rows[0], rows[-1] + 1) for name, rows in positions.items()}
+    return comparison, comparison_index
+
+# Rows of the indexed comparison for one KPI
+def get_kpi_data(comparison, comparison_index, kpi_name):
+    start, stop = comparison_index.get(kpi_name, (0, 0))
+    return comparison.iloc[start:stop]
+
+# Morning and afternoon periods searched for the peak value, as [start, end) times of day
+PEAK_PERIODS = {
+    'morning': (timedelta(hours=6), timedelta(hours=12)),
+    'afternoon': (timedelta(hours=12), timedelta(hours=20)),
+}
+# Peak hours span this long before and after the maximum value of a period
+PEAK_HALF_WIDTH = timedelta(hours=1)
+
+# Calculate the overall, morning peak and afternoon peak metrics of every KPI at once.
+# Returns one row per KPI name with the columns avg_forecasted, avg_actual, avg_error and,
+# for each period, <period>_avg_forecasted, <period>_avg_actual, <period>_avg_error and
+# <period>_peak_range; peak columns are missing values when a KPI has no data in the period.
+def calculate_all_metrics(comparison_data):
+    metric_columns = {'overallResult.value': 'avg_forecasted', 'value': 'avg_actual', 'ErrorPerc': 'avg_error'}
+    kpi_names = comparison_data['name']
+    forecasted_timestamps = pd.to_datetime(comparison_data['ForecastedTimestamp'])
+    values = comparison_data[list(metric_columns)].rename(columns=metric_columns)
+
+    metrics = values.groupby(kpi_names, observed=True).mean()
+    time_of_day = forecasted_timestamps - forecasted_timestamps.dt.normalize()
+    for period, (period_start, period_end) in PEAK_PERIODS.items():
+        in_period = (time_of_day >= period_start) & (time_of_day < period_end) & values['avg_actual'].notna()
+        # Timestamp of the first maximum actual value of each KPI within the period
+        peak_rows = values['avg_actual'][in_period].groupby(kpi_names[in_period], observed=True).idxmax()
+        peak_timestamps = forecasted_timestamps.loc[peak_rows.to_numpy()].set_axis(peak_rows.index)
+        peak_starts = peak_timestamps - PEAK_HALF_WIDTH
+        peak_ends = peak_timestamps + PEAK_HALF_WIDTH
+
+        row_peaks = peak_timestamps.reindex(kpi_names).set_axis(kpi_names.index)
+        in_peak = (forecasted_timestamps >= row_peaks - PEAK_HALF_WIDTH) & (forecasted_timestamps <= row_peaks + PEAK_HALF_WIDTH)
+        peak_metrics = values[in_peak].groupby(kpi_names[in_peak], observed=True).mean().add_prefix(f'{period}_')
+        peak_metrics[f'{period}_peak_range'] = peak_starts.dt.strftime('%H:%M') + ' - ' + peak_ends.dt.strftime('%H:%M')
+        metrics = metrics.join(peak_metrics)
+    metrics.index.name = 'name'
+    return metrics
+
+# Split one row of calculate_all_metrics into the overall, morning peak and afternoon peak dicts
+def split_metrics(metrics_row):
+    overall_metrics = {
+        'avg_forecasted': metrics_row.get('avg_forecasted', np.nan),
+        'avg_actual': metrics_row.get('avg_actual', np.nan),
+        'avg_error': metrics_row.get('avg_error', np.nan),
+    }
+    peak_metrics = []
+    for period in PEAK_PERIODS:
+        peak_range = metrics_row.get(f'{period}_peak_range')
+        if isinstance(peak_range, str):
+            peak_metrics.append({
+                'avg_forecasted': metrics_row[f'{period}_avg_forecasted'],
+                'avg_actual': metrics_row[f'{period}_avg_actual'],
+                'avg_error': metrics_row[f'{period}_avg_error'],
+                'peak_range': peak_range
+            })
+        else:
+            peak_metrics.append({
+                'avg_forecasted': None,
+                'avg_actual': None,
+                'avg_error': None,
+                'peak_range': f"No {period} data available"
+            })
+    morning_peak_metrics, afternoon_peak_metrics = peak_metrics
+    return overall_metrics, morning_peak_metrics, afternoon_peak_metrics
+
+# Calculate the metrics of a single KPI
+def calculate_metrics(kpi_data):
+    metrics = calculate_all_metrics(kpi_data)
+    return split_metrics(metrics.iloc[0] if not metrics.empty else {})
+
+# Match every forecast with the actual value of its KPI and progressive nearest to the
+# 5-minute bucket of the time it targets ('timeStamp' + 'timetostart', floored like the
+# 'RoundedTimeStamp' of the actuals), within tolerance_minutes. Both sides are sorted by
+# time once and joined in a single merge_asof; forecasts without an actual in range are
+# dropped. Returns one row per matched forecast with its horizon and the bucket and hour
+# of day (UTC) it targets.
+def match_forecasts_to_actuals(last_24_hours_data, grouped_historical_data, tolerance_minutes=ACCURACY_TOLERANCE_MINUTES):
+    columns = ['kpiId', 'progressive', 'timeStamp', 'TargetTimestamp', 'ActualTimestamp',
+               'horizon_minutes', 'hour', 'forecast', 'actual']
+    required = ['kpiId', 'timeStamp', 'timetostart', 'overallResult.value', 'overallResult.progressive']
+    if (last_24_hours_data.empty or grouped_historical_data.empty
+            or any(column not in last_24_hours_data.columns for column in required)):
+        return pd.DataFrame(columns=columns)
+    forecasts = last_24_hours_data[required].dropna()
+    # Share the kpiId categories between both sides, as merge_asof needs equal 'by' dtypes
+    kpi_dtype = pd.CategoricalDtype(
+        pd.Index(forecasts['kpiId'].astype(str).unique()).union(grouped_historical_data['kpiId'].astype(str).unique())
+    )
+    timestamps = pd.to_datetime(forecasts['timeStamp'], utc=True, format='ISO8601')
+    forecasts = pd.DataFrame({
+        'kpiId': forecasts['kpiId'].astype(str).astype(kpi_dtype),
+        'progressive': forecasts['overallResult.progressive'].astype('int64'),
+        'timeStamp': timestamps,
+        'TargetTimestamp': (timestamps + pd.to_timedelta(forecasts['timetostart'].astype('int64'), unit='s')).dt.floor('5min'),
+        'horizon_minutes': (forecasts['timetostart'] // 60).astype('int32'),
+        'forecast': forecasts['overallResult.value'].astype('float32'),
+    })
+    bucket_timestamps = pd.to_datetime(grouped_historical_data['RoundedTimeStamp'], utc=True)
+    actuals = pd.DataFrame({
+        'kpiId': grouped_historical_data['kpiId'].astype(str).astype(kpi_dtype),
+        'progressive': grouped_historical_data['progressive'].astype('int64'),
+        # Join key, and the bucket time kept as a value since merge_asof returns the left key
+        'TargetTimestamp': bucket_timestamps,
+        'ActualTimestamp': bucket_timestamps,
+        'actual': grouped_historical_data['value'].astype('float32'),
+    }).dropna(subset=['TargetTimestamp'])
+    forecasts['TargetTimestamp'] = forecasts['TargetTimestamp'].astype(bucket_timestamps.dtype)
+    matched = pd.merge_asof(
+        forecasts.sort_values('TargetTimestamp', kind='stable'),
+        actuals.sort_values('TargetTimestamp', kind='stable'),
+        on='TargetTimestamp', by=['kpiId', 'progressive'], direction='nearest',
+        tolerance=pd.Timedelta(minutes=tolerance_minutes)
+    )
+    matched = matched.dropna(subset=['actual'])
+    matched['hour'] = matched['TargetTimestamp'].dt.hour.astype('int8')
+    return matched[columns].reset_index(drop=True)
+
+# MAE, MAPE (%) and bias (mean forecast minus actual) of matched forecasts per group,
+# by default per forecast horizon and hour of day, computed in one groupby pass.
+# MAPE leaves out actual values of zero.
+def forecast_accuracy(matched, by=('horizon_minutes', 'hour')):
+    by = list(by)
+    columns = ['count', 'mae', 'mape', 'bias']
+    if matched.empty:
+        return pd.DataFrame(columns=columns, index=pd.MultiIndex.from_arrays([[]] * len(by), names=by))
+    error = matched['forecast'].astype('float64') - matched['actual'].astype('float64')
+    actual = matched['actual'].astype('float64')
+    errors = pd.DataFrame({
+        'error': error,
+        'abs_error': error.abs(),
+        'ape': (error.abs() / actual.abs()).where(actual != 0) * 100,
+    })
+    errors[by] = matched[by]
+    accuracy = errors.groupby(by, observed=True).agg(
+        count=('error', 'size'),
+        mae=('abs_error', 'mean'),
+        mape=('ape', 'mean'),
+        bias=('error', 'mean'),
+    )
+    return accuracy[columns]
+
+# Derive everything shown and exported from the per-KPI frames. Returns a dict with the
+# frames 'last_24_hours_data', 'historical_stats_data', 'grouped_historical_data',
+# 'comparison' projected on COMPARISON_SCHEMA and sorted by KPI name with its
+# 'comparison_index' (both None when there is nothing to compare), 'metrics',
+# 'forecast_matches' and 'accuracy' (per horizon and hour of day). With report=True, the
+# 'report' frame holds the comparison projected on REPORT_SCHEMA instead, in the same
+# order, for exporting. Each stage is timed into recorder, if given.
+def derive_results(kpi_ids_df, last_24_hours_frames, historical_frames, recorder=None, report=False):
+    with perf_span(recorder, "prepare.last_24_hours") as span:
+        last_24_hours_data = prepare_last_24_hours_data(last_24_hours_frames, kpi_ids_df)
+        span.set(rows=len(last_24_hours_data))
+    with perf_span(recorder, "assemble.historical") as span:
+        historical_stats_data = assemble_frames(historical_frames)
+        span.set(rows=len(historical_stats_data))
+    with perf_span(recorder, "group.historical", input_rows=len(historical_stats_data)) as span:
+        grouped_historical_data = group_historical_data(historical_stats_data)
+        span.set(rows=len(grouped_historical_data))
+    comparison_index = None
+    metrics = None
+    report_frame = None
+    with perf_span(recorder, "compare.merge") as span:
+        comparison = compare_forecasts(last_24_hours_data, grouped_historical_data, kpi_ids_df[['kpiId', 'name']])
+        if comparison is not None:
+            span.set(rows=len(comparison))
+    if comparison is not None:
+        with perf_span(recorder, "compare.project") as span:
+            # Measuring deep memory scans every value, so only done when timing the stages
+            bytes_before = frame_memory(comparison) if recorder is not None else None
+            if report:
+                report_frame = project_comparison(comparison.rename(columns=REPORT_RENAMES), REPORT_SCHEMA)
+                report_frame, _ = build_comparison_index(report_frame)
+            comparison = project_comparison(comparison)
+            comparison, comparison_index = build_comparison_index(comparison)
+            if recorder is not None:
+                span.set(rows=len(comparison), bytes=frame_memory(comparison), bytes_before=bytes_before)
+                logger.info(
+                    f"Comparison memory: {bytes_before / 2**20:.1f} MiB before projection, "
+                    f"{span.attributes['bytes'] / 2**20:.1f} MiB after ({len(comparison)} rows)"
+                )
+    if comparison is not None:
+        with perf_span(recorder, "metrics") as span:
+            metrics = calculate_all_metrics(comparison)
+            span.set(rows=len(metrics))
+    with perf_span(recorder, "accuracy") as span:
+        forecast_matches = match_forecasts_to_actuals(last_24_hours_data, grouped_historical_data)
+        accuracy = forecast_accuracy(forecast_matches)
+        span.set(rows=len(forecast_matches))
+    return {
+        'last_24_hours_data': last_24_hours_data,
+        'historical_stats_data': historical_stats_data,
+        'grouped_historical_data': grouped_historical_data,
+        'comparison': comparison,
+        'comparison_index': comparison_index,
+        'metrics': metrics,
+        'forecast_matches': forecast_matches,
+        'accuracy': accuracy,
+        'report': report_frame,
+    }
+
+# Run the whole pipeline for one tenant. Returns the results of derive_results(), with the
+# 'report' frame if report is set, plus the 'kpi_definitions' frame and the 'failed_kpis'
+# dict. Each stage is timed into recorder, if given.
+def run_pipeline(api_key, max_workers=DEFAULT_MAX_WORKERS, rate_limit=DEFAULT_RATE_LIMIT, cache=None, progress=None,
+                 recorder=None, report=False):
+    kpi_ids_df = fetch_kpi_definitions(api_key, recorder=recorder)
+    kpi_ids = kpi_ids_df['kpiId']
+    if cache is not None:
+        with perf_span(recorder, "cache.evict"):
+            cache.evict(keep_kpi_ids=kpi_ids)
+    last_24_hours_frames, historical_frames, failed_kpis = fetch_all_kpi_data(
+        kpi_ids, api_key, max_workers=max_workers, progress=progress, cache=cache, rate_limit=rate_limit,
+        recorder=recorder
+    )
+    results = derive_results(kpi_ids_df, last_24_hours_frames, historical_frames, recorder=recorder, report=report)
+    results['kpi_definitions'] = kpi_ids_df
+    results['failed_kpis'] = failed_kpis
+    return results
+
+# Runs the fetch and derivation of a tenant in a background thread. While KPIs complete,
+# the results of derive_results() over the KPIs loaded so far are published at most every
+# publish_interval seconds; readers poll snapshot(). A refresh passes the kpi_ids_df and
+# frames() of the previous worker: the KPI definitions are not fetched again and the
+# previous frames of a KPI are shown until its new ones arrive.
+# Partial publications are timed as one 'derive.partial' span each, and only the final
+# one per stage, so recorder holds the stages of this run once. When every KPI was fetched,
+# the final derivation is passed to derive_final(derive, kpi_set_key(loaded KPIs)), if
+# given, which may return results shared with other workers; the results of a fetch with
+# failed KPIs are never shared.
+class RefreshWorker:
+    def __init__(self, api_key, kpi_ids_df=None, previous_frames=None, max_workers=DEFAULT_MAX_WORKERS,
+                 rate_limit=DEFAULT_RATE_LIMIT, cache=None, recorder=None,
+                 fetch_last_24_hours=fetch_last_24_hours_data, fetch_historical=fetch_historical_stats_cached,
+                 publish_interval=PUBLISH_INTERVAL_SECONDS, derive_final=None):
+        self.api_key = api_key
+        self.kpi_ids_df = kpi_ids_df
+        self.max_workers = max_workers
+        self.rate_limit = rate_limit
+        self.cache = cache
+        self.recorder = recorder
+        self.fetch_last_24_hours = fetch_last_24_hours
+        self.fetch_historical = fetch_historical
+        self.publish_interval = publish_interval
+        self.derive_final = derive_final
+        last_24_hours_frames, historical_frames = previous_frames or ({}, {})
+        self._frames = {'last_24_hours': dict(last_24_hours_frames), 'historical': dict(historical_frames)}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._published_at = 0.0
+        self.status = 'pending'  # pending, running, done, cancelled or failed
+        self.error = None
+        self.progress = ""
+        self.failed_kpis = {}
+        self.started_at = None
+        self.finished_at = None
+        self._version = 0
+        self._results = None
+
+    def start(self):
+        self.status = 'running'
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="ptvflows-refresh", daemon=True)
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._stop.set()
+
+    @property
+    def running(self):
+        return self.status in ('pending', 'running')
+
+    # Version of the last published results and the results, None until the first publication
+    def snapshot(self):
+        with self._lock:
+            return self._version, self._results
+
+    # Per-KPI frames fetched so far, for a later refresh
+    def frames(self):
+        with self._lock:
+            return dict(self._frames['last_24_hours']), dict(self._frames['historical'])
+
+    def _set_progress(self, message):
+        self.progress = message
+
+    def _on_result(self, kind, kpi_id, frame):
+        with self._lock:
+            self._frames[kind][kpi_id] = frame
+        if time.monotonic() - self._published_at >= self.publish_interval:
+            self._publish()
+
+    def _publish(self, final=False):
+        last_24_hours_frames, historical_frames = self.frames()
+        loaded = [kpi_id for kpi_id in self.kpi_ids_df['kpiId']
+                  if kpi_id in last_24_hours_frames and kpi_id in historical_frames]
+        last_24_hours_frames = [last_24_hours_frames[kpi_id] for kpi_id in loaded]
+        historical_frames = [historical_frames[kpi_id] for kpi_id in loaded]
+        if final:
+            def derive():
+                return derive_results(self.kpi_ids_df, last_24_hours_frames, historical_frames, recorder=self.recorder)
+            if self.derive_final is None or self.failed_kpis:
+                results = derive()
+            else:
+                # Copied, as results returned by derive_final may be shared
+                results = dict(self.derive_final(derive, kpi_set_key(loaded)))
+        else:
+            with perf_span(self.recorder, "derive.partial", loaded_kpis=len(loaded)):
+                results = derive_results(self.kpi_ids_df, last_24_hours_frames, historical_frames)
+        results['kpi_definitions'] = self.kpi_ids_df
+        results['failed_kpis'] = dict(self.failed_kpis)
+        results['loaded_kpis'] = len(loaded)
+        with self._lock:
+            self._version += 1
+            self._results = results
+        # Measured after deriving, so slow derivations do not hog the worker thread
+        self._published_at = time.monotonic()
+
+    def _run(self):
+        try:
+            with perf_span(self.recorder, "refresh", incremental=self.kpi_ids_df is not None):
+                if self.kpi_ids_df is None:
+                    self.progress = "Fetching KPI definitions..."
+                    self.kpi_ids_df = fetch_kpi_definitions(self.api_key, recorder=self.recorder)
+                kpi_ids = self.kpi_ids_df['kpiId']
+                if self.cache is not None:
+                    with perf_span(self.recorder, "cache.evict"):
+                        self.cache.evict(keep_kpi_ids=kpi_ids)
+                _, _, self.failed_kpis = fetch_all_kpi_data(
+                    kpi_ids, self.api_key, max_workers=self.max_workers, progress=self._set_progress, cache=self.cache,
+                    fetch_last_24_hours=self.fetch_last_24_hours, fetch_historical=self.fetch_historical,
+                    rate_limit=self.rate_limit, recorder=self.recorder, on_result=self._on_result, stop=self._stop
+                )
+                if self._stop.is_set():
+                    self.status = 'cancelled'
+                    return
+                self._publish(final=True)
+            self.status = 'done'
+        except Exception as e:
+            logger.exception("Refresh failed")
+            self.error = str(e)
+            self.status = 'failed'
+        finally:
+            self.finished_at = time.time()
+
+# Write a frame as Parquet or CSV and return the path written
+def write_frame(df, path, output_format):
+    path = f"{path}.{output_format}"
+    if output_format == 'parquet':
+        df.to_parquet(path)
+    else:
+        df.to_csv(path)
+    return path
+
+# Run the pipeline for one tenant and write its comparison, metrics, accuracy and failed KPIs to
+# output_dir/<tenant_key>/, plus the timing spans as OTLP/JSON when perf is set; returns
+# the paths written
+def export_tenant(api_key, output_dir, output_format='parquet', max_workers=DEFAULT_MAX_WORKERS,
+                  rate_limit=DEFAULT_RATE_LIMIT, use_cache=True, retention_days=DEFAULT_CACHE_RETENTION_DAYS,
+                  perf=False):
+    cache = HistoricalStatsCache(api_key, retention_days=retention_days) if use_cache else None
+    recorder = PerfRecorder() if perf else None
+    with perf_span(recorder, "pipeline", tenant=tenant_key(api_key)):
+        result = run_pipeline(
+            api_key, max_workers=max_workers, rate_limit=rate_limit, cache=cache, recorder=recorder, report=True
+        )
+    tenant_dir = os.path.join(output_dir, tenant_key(api_key))
+    os.makedirs(tenant_dir, exist_ok=True)
+    written = []
+    if result['comparison'] is not None:
+        written.append(write_frame(result['report'], os.path.join(tenant_dir, 'comparison'), output_format))
+        written.append(write_frame(result['metrics'], os.path.join(tenant_dir, 'metrics'), output_format))
+        written.append(write_frame(result['accuracy'], os.path.join(tenant_dir, 'accuracy'), output_format))
+    else:
+        logger.warning(f"No data available for comparison for tenant {tenant_key(api_key)}")
+    if result['failed_kpis']:
+        failed = pd.DataFrame({'kpiId': list(result['failed_kpis']), 'error': list(result['failed_kpis'].values())})
+        written.append(write_frame(failed.set_index('kpiId'), os.path.join(tenant_dir, 'failed_kpis'), 'csv'))
+    if recorder is not None:
+        path = os.path.join(tenant_dir, 'perf_spans.json')
+        with open(path, 'w') as f:
+            f.write(recorder.to_json())
+        written.append(path)
+        logger.info(f"Stage timings for tenant {tenant_key(api_key)}:\n{recorder.summary()}")
+    return written
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Fetch PTV Flows KPI forecasts and history, compare them and export the comparison and metrics."
+    )
+    parser.add_argument('--api-key', action='append', default=[],
+                        help="API key of a tenant; repeat for several tenants (default: $PTV_API_KEY)")
+    parser.add_argument('--api-key-file', help="File with one API key per line")
+    parser.add_argument('--output-dir', default='output', help="Directory receiving one sub-directory per tenant")
+    parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet', dest='output_format')
+    parser.add_argument('--processes', type=int, default=1, help="Tenants processed in parallel worker processes")
+    parser.add_argument('--max-concurrent', type=int, default=DEFAULT_MAX_WORKERS, help="Concurrent requests per tenant")
+    parser.add_argument('--rate-limit', type=float, default=DEFAULT_RATE_LIMIT, help="Requests per second per tenant")
+    parser.add_argument('--api-root', help="Root URL of the API (default: $PTVFLOWS_API_ROOT or https://api.myptv.com)")
+    parser.add_argument('--no-cache', action='store_true', help="Do not use the local historical stats cache")
+    parser.add_argument('--cache-retention-days', type=int, default=DEFAULT_CACHE_RETENTION_DAYS)
+    parser.add_argument('--perf', action='store_true',
+                        help="Time every stage and write the spans to perf_spans.json (OTLP/JSON) per tenant")
+    parser.add_argument('--log-level', default=DEFAULT_LOG_LEVEL,
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], type=str.upper,
+                        help="Log level (default: $PTVFLOWS_LOG_LEVEL or INFO)")
+    args = parser.parse_args(argv)
+    if args.api_key_file:
+        with open(args.api_key_file) as f:
+            args.api_key.extend(line.strip() for line in f if line.strip())
+    if not args.api_key and os.environ.get('PTV_API_KEY'):
+        args.api_key.append(os.environ['PTV_API_KEY'])
+    if not args.api_key:
+        parser.error("no API key given (use --api-key, --api-key-file or $PTV_API_KEY)")
+    return args
+
+# Set up logging and the API root of a CLI process, including the worker processes
+def init_process(log_level, api_root=None):
+    configure_logging(log_level)
+    if api_root:
+        set_api_root(api_root)
+
+def main(argv=None):
+    args = parse_args(argv)
+    init_process(args.log_level, args.api_root)
+    options = dict(
+        output_dir=args.output_dir, output_format=args.output_format, max_workers=args.max_concurrent,
+        rate_limit=args.rate_limit, use_cache=not args.no_cache, retention_days=args.cache_retention_days,
+        perf=args.perf
+    )
+    failures = 0
+    with ProcessPoolExecutor(max_workers=max(1, min(args.processes, len(args.api_key))),
+                             initializer=init_process, initargs=(args.log_level, args.api_root)) as executor:
+        futures = {executor.submit(export_tenant, api_key, **options): tenant_key(api_key) for api_key in args.api_key}
+        for future in as_completed(futures):
+            try:
+                for path in future.result():
+                    logger.info(f"Wrote {path}")
+            except requests.RequestException as e:
+                failures += 1
+                logger.error(f"Export failed for tenant {futures[future]}: {e}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
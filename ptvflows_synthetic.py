@@ -0,0 +1,243 @@
+import argparse
+import functools
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+# Synthetic PTV Flows API: payloads shaped like the responses of the KPI definitions,
+# last 24 hours and historical stats endpoints, and a local mock server serving them.
+# Point the app or the CLI at it with $PTVFLOWS_API_ROOT:
+#   python ptvflows_synthetic.py --kpis 200 --history-hours 720 --port 8080
+#   PTVFLOWS_API_ROOT=http://127.0.0.1:8080 streamlit run streamlit_app.py
+
+logger = logging.getLogger(__name__)
+
+# Minutes between two results, as published by the API
+RESULT_INTERVAL_MINUTES = 5
+# Forecast horizons, in seconds, drawn for the KPI instances
+TIMETOSTART_CHOICES = [0, 900, 1800, 3600]
+# Morning and afternoon rush hours of the daily profile, as (peak minute of day, width in minutes, weight)
+RUSH_HOURS = [(8 * 60, 70, 1.0), (17 * 60 + 30, 90, 0.8)]
+# Relative noise of the actual values and of the forecasts
+ACTUAL_NOISE = 0.05
+FORECAST_NOISE = 0.12
+
+def iso_timestamp(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + f"{dt.microsecond // 1000:03d}Z"
+
+# Deterministic synthetic KPIs. Each KPI has a travel-time-like daily profile with two
+# rush hours; historical results split the actual value over the progressives and the
+# last 24 hours results forecast the actual value timetostart seconds ahead, so the
+# forecasts match the history as in the real API.
+class SyntheticKpis:
+    def __init__(self, n_kpis=50, history_hours=48, progressives=2, seed=0, now=None):
+        if now is None:
+            now = datetime.now(timezone.utc)
+        self.now = now.replace(minute=now.minute - now.minute % RESULT_INTERVAL_MINUTES, second=0, microsecond=0)
+        self.history_hours = history_hours
+        self.progressives = progressives
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.kpi_ids = [str(uuid.UUID(bytes=rng.bytes(16), version=4)) for _ in range(n_kpis)]
+        self._index = {kpi_id: i for i, kpi_id in enumerate(self.kpi_ids)}
+        self.timetostart = rng.choice(TIMETOSTART_CHOICES, n_kpis)
+        self.base = rng.uniform(60, 600, n_kpis)
+        self.amplitude = rng.uniform(0.3, 1.5, n_kpis)
+        # 5-minute grid covering the history, the last 24 hours and the longest horizon
+        past = max(history_hours, 24) * 60 // RESULT_INTERVAL_MINUTES
+        ahead = max(TIMETOSTART_CHOICES) // 60 // RESULT_INTERVAL_MINUTES
+        self._grid_start = self.now - timedelta(minutes=past * RESULT_INTERVAL_MINUTES)
+        self._grid_size = past + ahead + 1
+
+    def __contains__(self, kpi_id):
+        return kpi_id in self._index
+
+    def _rng(self, kpi_id, stream):
+        return np.random.default_rng([self.seed, self._index[kpi_id], stream])
+
+    def _grid(self, steps):
+        return [self._grid_start + timedelta(minutes=RESULT_INTERVAL_MINUTES * int(step)) for step in steps]
+
+    # Noise-free and actual values of a KPI on the whole 5-minute grid
+    def _profile(self, kpi_id):
+        i = self._index[kpi_id]
+        minutes = (self._grid_start.hour * 60 + self._grid_start.minute
+                   + np.arange(self._grid_size) * RESULT_INTERVAL_MINUTES) % (24 * 60)
+        rush = sum(weight * np.exp(-((minutes - peak) / width) ** 2) for peak, width, weight in RUSH_HOURS)
+        expected = self.base[i] * (1 + self.amplitude[i] * rush)
+        actual = expected * (1 + self._rng(kpi_id, 0).normal(0, ACTUAL_NOISE, self._grid_size))
+        return expected, actual
+
+    def kpi_definitions(self):
+        return [{
+            'kpiId': kpi_id,
+            'name': f"Synthetic KPI {i:04d}",
+            'template': 'TRAVEL_TIME',
+            'kpiInstanceParameters': {'parameters': {'timetostart': int(self.timetostart[i])}},
+        } for i, kpi_id in enumerate(self.kpi_ids)]
+
+    # Forecasts published over the last 24 hours, one per 5 minutes, for the latest progressive
+    def last_24_hours(self, kpi_id):
+        i = self._index[kpi_id]
+        rng = self._rng(kpi_id, 1)
+        _, actual = self._profile(kpi_id)
+        now_step = self._grid_size - 1 - max(TIMETOSTART_CHOICES) // 60 // RESULT_INTERVAL_MINUTES
+        steps = np.arange(now_step - 24 * 60 // RESULT_INTERVAL_MINUTES + 1, now_step + 1)
+        horizon = int(self.timetostart[i]) // 60 // RESULT_INTERVAL_MINUTES
+        forecasts = actual[steps + horizon] * (1 + rng.normal(0, FORECAST_NOISE, len(steps)))
+        jitter = rng.integers(0, 50, len(steps))
+        progressive = self.progressives - 1
+        return [{
+            'kpiId': kpi_id,
+            'timeStamp': iso_timestamp(timestamp + timedelta(seconds=int(seconds))),
+            'overallResult': {'value': float(value), 'progressive': progressive, 'unit': 'SECONDS'},
+            'results': [{'progressive': progressive, 'value': float(value), 'location': {'type': 'segment'}}],
+        } for timestamp, seconds, value in zip(self._grid(steps), jitter, forecasts)]
+
+    # Historical results over history_hours, one entry per 5 minutes with one result per progressive
+    def historical(self, kpi_id):
+        rng = self._rng(kpi_id, 2)
+        expected, actual = self._profile(kpi_id)
+        now_step = self._grid_size - 1 - max(TIMETOSTART_CHOICES) // 60 // RESULT_INTERVAL_MINUTES
+        steps = np.arange(now_step - self.history_hours * 60 // RESULT_INTERVAL_MINUTES + 1, now_step + 1)
+        shares = np.full(self.progressives, 1 / self.progressives)
+        jitter = rng.integers(0, 50, len(steps))
+        unusual = rng.random(len(steps)) < 0.02
+        entries = []
+        for timestamp, seconds, step, is_unusual in zip(self._grid(steps), jitter, steps, unusual):
+            entries.append({
+                'timeStamp': iso_timestamp(timestamp + timedelta(seconds=int(seconds))),
+                'results': [{
+                    'progressive': progressive,
+                    'value': float(actual[step] * share),
+                    'defaultValue': float(expected[step] * share),
+                    'averageValue': float(expected[step] * share * 1.02),
+                    'unusualValue': float(actual[step] * share) if is_unusual else 0.0,
+                } for progressive, share in enumerate(shares)],
+            })
+        return entries
+
+# Request handler of MockPtvServer, routing the three endpoints used by the pipeline
+class MockPtvHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send_body(self, status, body=b"", headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if not self.headers.get('apiKey'):
+            return self.send_body(401, b'{"description": "Missing apiKey"}')
+        if server.latency:
+            time.sleep(server.latency)
+        if server.fail_rate and server.random() < server.fail_rate:
+            # Throttle half of the injected failures and make the other half unavailable
+            if server.random() < 0.5:
+                return self.send_body(429, headers={'Retry-After': '0.1'})
+            return self.send_body(503)
+        url = urlparse(self.path)
+        kpi_id = parse_qs(url.query).get('kpiId', [None])[0]
+        if url.path.endswith('/kpieng/v1/instance/all'):
+            return self.send_body(200, server.payload('definitions', None))
+        if url.path.endswith('/kpieng/v1/result/by-kpi-id') and kpi_id in server.kpis:
+            return self.send_body(200, server.payload('last_24_hours', kpi_id))
+        if url.path.endswith('/kpistats/v1/historical/result/by-kpi-id') and kpi_id in server.kpis:
+            return self.send_body(200, server.payload('historical', kpi_id))
+        self.send_body(404, b'{"description": "Not found"}')
+
+# Local HTTP server serving SyntheticKpis payloads. fail_rate injects 429 and 503
+# responses and latency (seconds) delays every response, to exercise the retries
+class MockPtvServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, kpis, address=("127.0.0.1", 0), fail_rate=0.0, latency=0.0, payload_cache_size=64):
+        super().__init__(address, MockPtvHandler)
+        self.kpis = kpis
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self._random = random.Random(kpis.seed)
+        self._random_lock = threading.Lock()
+        self.payload = functools.lru_cache(maxsize=payload_cache_size)(self._encode)
+
+    @property
+    def api_root(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def random(self):
+        with self._random_lock:
+            return self._random.random()
+
+    def _encode(self, endpoint, kpi_id):
+        if endpoint == 'definitions':
+            return json.dumps(self.kpis.kpi_definitions()).encode('utf-8')
+        if endpoint == 'last_24_hours':
+            return json.dumps(self.kpis.last_24_hours(kpi_id)).encode('utf-8')
+        return json.dumps(self.kpis.historical(kpi_id)).encode('utf-8')
+
+    # Serve in a daemon thread; returns the server
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+# Comma-separated list of KPI counts, e.g. "50,200,800"
+def kpi_counts(value):
+    try:
+        counts = [int(count) for count in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid KPI counts: {value!r}")
+    if any(count < 1 for count in counts):
+        raise argparse.ArgumentTypeError(f"KPI counts must be positive: {value!r}")
+    return counts
+
+# Arguments of the synthetic data; with kpi_sweep, --kpis takes a list of counts to sweep
+def add_synthetic_arguments(parser, kpi_sweep=False):
+    if kpi_sweep:
+        parser.add_argument('--kpis', type=kpi_counts, default=[50],
+                            help="Number of KPIs, or a comma-separated list of counts to sweep, e.g. 50,200,800")
+    else:
+        parser.add_argument('--kpis', type=int, default=50, help="Number of KPIs")
+    parser.add_argument('--history-hours', type=int, default=48, help="Hours of historical stats per KPI")
+    parser.add_argument('--progressives', type=int, default=2, help="Progressives per historical result")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="Share of requests answered with 429 or 503")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Delay added to every response")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a synthetic PTV Flows API for local runs and benchmarks.")
+    add_synthetic_arguments(parser)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    kpis = SyntheticKpis(args.kpis, args.history_hours, args.progressives, args.seed)
+    server = MockPtvServer(kpis, (args.host, args.port), args.fail_rate, args.latency_ms / 1000)
+    logger.info(f"Serving {args.kpis} synthetic KPIs at {server.api_root} (set PTVFLOWS_API_ROOT={server.api_root})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
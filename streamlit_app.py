@@ -1,127 +1,295 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
+import functools
+import io
 import logging
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+from ptvflows_pipeline import (
+    DEFAULT_CACHE_RETENTION_DAYS,
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_RATE_LIMIT,
+    HistoricalStatsCache,
+    PerfRecorder,
+    RefreshWorker,
+    calculate_metrics,
+    configure_logging,
+    fetch_historical_stats_cached,
+    fetch_kpi_definitions,
+    fetch_last_24_hours_data,
+    forecast_accuracy,
+    get_kpi_data,
+    perf_span,
+    split_metrics,
+    to_utc,
+)
 
 
-# Enable logging
-logging.basicConfig(level=logging.DEBUG)
+# Enable logging, at the level set by $PTVFLOWS_LOG_LEVEL (default INFO)
+configure_logging()
+logger = logging.getLogger(__name__)
 
-# Define the base URLs for the different API endpoints
-BASEURL = "api.myptv.com"
-KPI_ENG_URL = f"https://{BASEURL}/kpieng/v1/instance/all"
-KPI_HISTORICAL_URL = f"https://{BASEURL}/kpistats/v1/historical/result/by-kpi-id"
-KPI_24HOURS_URL = f"https://{BASEURL}/kpieng/v1/result/by-kpi-id"
+# Lifetime of the memoized fetch and transform stages: one 5-minute bucket
+CACHE_TTL_SECONDS = 300
+
+# Chart resolutions offered on the KPI Analysis page, as maximum points per trace
+CHART_RESOLUTIONS = {'500 points': 500, '1000 points': 1000, '2000 points': 2000, '5000 points': 5000, 'Full': None}
+DEFAULT_CHART_RESOLUTION = '2000 points'
+# Traces with more points than this are rendered with WebGL (Scattergl)
+SCATTERGL_THRESHOLD = 1000
+# Charts kept per session for the reruns that do not change them, as (KPI, resolution) pairs
+CHART_CACHE_ENTRIES = 8
+
+# Seconds between two polls of a running background refresh, and of a finished one while
+# waiting for the next auto-refresh
+REFRESH_POLL_SECONDS = 1
+AUTO_REFRESH_POLL_SECONDS = 15
+# Auto-refresh intervals, in minutes: multiples of the 5-minute bucket of the results
+AUTO_REFRESH_INTERVALS = {'Off': None, 'Every 5 minutes': 5, 'Every 15 minutes': 15, 'Every 30 minutes': 30}
+
+# Rows per page offered by the paginated tables
+TABLE_PAGE_SIZES = [25, 50, 100, 500]
+DEFAULT_TABLE_PAGE_SIZE = 50
 
 # Initialize session state for API key
 if 'api_key' not in st.session_state:
     st.session_state.api_key = ""
 if 'comparison_data' not in st.session_state:
     st.session_state.comparison_data = None
+if 'comparison_index' not in st.session_state:
+    st.session_state.comparison_index = None
+if 'kpi_metrics' not in st.session_state:
+    st.session_state.kpi_metrics = None
 if 'kpi_ids_df' not in st.session_state:
     st.session_state.kpi_ids_df = None
+if 'cache_epoch' not in st.session_state:
+    st.session_state.cache_epoch = 0
+if 'perf' not in st.session_state:
+    st.session_state.perf = PerfRecorder()
+if 'forecast_accuracy' not in st.session_state:
+    st.session_state.forecast_accuracy = None
+if 'horizon_accuracy' not in st.session_state:
+    st.session_state.horizon_accuracy = None
+if 'fetched_tables' not in st.session_state:
+    st.session_state.fetched_tables = {}
+if 'kpi_charts' not in st.session_state:
+    st.session_state.kpi_charts = {}
+if 'refresh_worker' not in st.session_state:
+    st.session_state.refresh_worker = None
+if 'refresh_settings' not in st.session_state:
+    st.session_state.refresh_settings = None
+if 'published_version' not in st.session_state:
+    st.session_state.published_version = None
+if 'finished_worker' not in st.session_state:
+    st.session_state.finished_worker = None
 
-# Define headers for the API requests
-def get_headers():
-    return {
-        "apiKey": st.session_state.api_key,
-        "Accept": "*/*",
-        "Connection": "keep-alive"
-    }
-
-def extract_timetostart(param_dict):
-    try:
-        return param_dict.get('parameters', {}).get('timetostart', None)
-    except AttributeError:
-        return None
+# Fetch the KPI definitions of a tenant; memoized per API key
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def load_kpi_definitions(api_key, cache_epoch=0):
+    return fetch_kpi_definitions(api_key)
 
 # Fetch all KPI definitions
 def fetch_all_kpis():
     try:
-        print("Fetching all KPI definitions...")
-        response = requests.get(KPI_ENG_URL, headers=get_headers())
-        response.raise_for_status()  # Raise an exception if the response status code is not 200
-        kpi_data = response.json()
-        kpi_df = pd.DataFrame(kpi_data)
-        kpi_df['timetostart'] = kpi_df['kpiInstanceParameters'].apply(extract_timetostart)
-        print(f"Fetched {len(kpi_df)} KPIs.")
-        print(kpi_df.head())
-        return kpi_df
+        return load_kpi_definitions(st.session_state.api_key, st.session_state.cache_epoch)
     except requests.RequestException as e:
         st.error(f"Error fetching data: {e}")
         return None
 
-# Fetch last 24 hours data for a specific KPI
-def fetch_last_24_hours_data(kpi_id):
-    print(f"Fetching last 24 hours data for KPI: {kpi_id}")
-    url = f"{KPI_24HOURS_URL}?kpiId={kpi_id}"
-    response = requests.get(url, headers=get_headers())
-    if response.status_code == 200:
-        data = response.json()
-        df = pd.json_normalize(data)
-        if 'timeStamp' in df.columns:
-            df['RoundedTimeStamp'] = df['timeStamp'].apply(round_to_nearest_5min)
-        df['kpiId'] = kpi_id  # Ensure 'kpiId' is in the DataFrame
-        print(f"Fetched last 24 hours data for KPI: {kpi_id}")
-        return df
+# Raised inside the memoized fetches when nothing was fetched, so failures are not cached
+class NoDataFetched(Exception):
+    pass
+
+# Per-KPI raw fetches, memoized per API key and KPI for all sessions of the deployment
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def load_last_24_hours_data(api_key, kpi_id, cache_epoch, _session):
+    df = fetch_last_24_hours_data(kpi_id, _session)
+    if df.empty:
+        raise NoDataFetched(kpi_id)
+    return df
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def load_historical_stats(api_key, kpi_id, cache_epoch, _session, _cache=None):
+    df = fetch_historical_stats_cached(kpi_id, _session, _cache)
+    if df.empty:
+        raise NoDataFetched(kpi_id)
+    return df
+
+# Per-KPI fetch functions for fetch_all_kpi_data that go through the memoized fetches
+def memoized_fetchers(api_key, cache_epoch=0):
+    def fetch_last_24_hours(kpi_id, session):
+        try:
+            return load_last_24_hours_data(api_key, kpi_id, cache_epoch, session)
+        except NoDataFetched:
+            return pd.DataFrame()
+
+    def fetch_historical(kpi_id, session, cache=None):
+        try:
+            return load_historical_stats(api_key, kpi_id, cache_epoch, session, cache)
+        except NoDataFetched:
+            return pd.DataFrame()
+
+    return fetch_last_24_hours, fetch_historical
+
+# Final results of a complete refresh, derived once per API key, cache epoch, 5-minute
+# bucket of the start of the fetch, kind of refresh and set of loaded KPIs, and shared by
+# the sessions of the tenant. Keyed by the fetch rather than by hashing its frames, which
+# change on every refresh; the worker does not share the results of incomplete fetches.
+@st.cache_resource(ttl=CACHE_TTL_SECONDS, show_spinner=False)
+def load_final_results(api_key, cache_epoch, fetch_bucket, incremental, _derive, kpi_set):
+    return _derive()
+
+# Start fetching in a background RefreshWorker with the given settings, replacing the
+# running one. A first fetch goes through the memoized per-KPI fetches; an auto-refresh
+# passes the previous worker, reuses its KPI definitions and frames and fetches directly,
+# so the newest 5-minute buckets are not served from the memoized fetches. Each worker
+# times into its own recorder, so a cancelled one cannot add spans to the next.
+def start_refresh(settings, kpi_ids_df, previous=None):
+    worker = st.session_state.refresh_worker
+    if worker is not None:
+        worker.cancel()
+    if previous is not None:
+        st.session_state.perf = PerfRecorder()
+    recorder = st.session_state.perf
+    derive_final = functools.partial(
+        load_final_results, settings['api_key'], st.session_state.cache_epoch,
+        int(time.time() // CACHE_TTL_SECONDS), previous is not None
+    )
+    cache = None
+    if settings['use_cache']:
+        cache = HistoricalStatsCache(settings['api_key'], retention_days=settings['retention_days'])
+    if previous is None:
+        fetch_last_24_hours, fetch_historical = memoized_fetchers(settings['api_key'], st.session_state.cache_epoch)
     else:
-        print(f"Failed to fetch data for KPI: {kpi_id}, Status Code: {response.status_code}, Response: {response.text}")
-    return pd.DataFrame()
-
-# Fetch historical stats for a specific KPI
-def fetch_historical_stats(kpi_id):
-    print(f"Fetching historical stats for KPI: {kpi_id}")
-    url = f"{KPI_HISTORICAL_URL}?kpiId={kpi_id}"
-    response = requests.get(url, headers=get_headers())
-    if response.status_code == 200:
-        data = response.json()
-        historical_data = []
-        for entry in data:
-            if 'timeStamp' in entry and 'results' in entry:
-                timestamp = entry['timeStamp']
-                for result in entry['results']:
-                    result['timeStamp'] = timestamp  # Ensure the 'timeStamp' is included in each result
-                    result['RoundedTimeStamp'] = round_to_nearest_5min(timestamp)
-                    result['kpiId'] = kpi_id
-                    historical_data.append(result)
-        df = pd.DataFrame(historical_data)
-        print(f"Fetched historical stats for KPI: {kpi_id}")
-        return df
+        fetch_last_24_hours, fetch_historical = fetch_last_24_hours_data, fetch_historical_stats_cached
+    st.session_state.refresh_worker = RefreshWorker(
+        settings['api_key'], kpi_ids_df=kpi_ids_df, previous_frames=previous.frames() if previous else None,
+        max_workers=settings['max_workers'], rate_limit=settings['rate_limit'], cache=cache, recorder=recorder,
+        fetch_last_24_hours=fetch_last_24_hours, fetch_historical=fetch_historical, derive_final=derive_final
+    ).start()
+    st.session_state.refresh_settings = settings
+
+# Store results published by the refresh worker in the session state, where both pages
+# read them. The session only holds references to the frames of the worker's results
+def publish_results(results):
+    st.session_state.kpi_ids_df = results['kpi_definitions']
+    st.session_state.comparison_data = results['comparison']
+    st.session_state.comparison_index = results['comparison_index']
+    st.session_state.kpi_metrics = results['metrics']
+    st.session_state.kpi_charts = {}
+    # Accuracy per horizon and hour of day, and per horizon alone, computed once per publication
+    st.session_state.forecast_accuracy = results['accuracy']
+    st.session_state.horizon_accuracy = forecast_accuracy(results['forecast_matches'], by=['horizon_minutes'])
+    # Keep the fetched tables for the reruns triggered by paging and filtering them
+    st.session_state.fetched_tables = {
+        'failed_kpis': results['failed_kpis'],
+        'kpi_definitions': results['kpi_definitions'],
+        'last_24_hours_data': results['last_24_hours_data'],
+        'historical_stats_data': results['historical_stats_data'],
+        'grouped_historical_data': results['grouped_historical_data'],
+        'comparison': results['comparison'],
+    }
+
+# Progress of the background refresh, run as a fragment polling the worker: new results
+# are published to the session state and the whole page is rerun to show them; when an
+# auto-refresh is due, it is started
+def refresh_status():
+    worker = st.session_state.refresh_worker
+    if worker is None:
+        return
+    version, results = worker.snapshot()
+    if results is not None and st.session_state.published_version != (id(worker), version):
+        publish_results(results)
+        st.session_state.published_version = (id(worker), version)
+        st.rerun()
+    if worker.running:
+        total = len(worker.kpi_ids_df) if worker.kpi_ids_df is not None else 0
+        loaded = results['loaded_kpis'] if results is not None else 0
+        st.progress(loaded / total if total else 0.0, text=f"Loaded {loaded}/{total} KPIs")
+        st.caption(worker.progress)
+        if st.button("Cancel refresh"):
+            worker.cancel()
+        return
+    if st.session_state.finished_worker != id(worker):
+        # Rerun once more so the page stops polling at the refresh rate
+        st.session_state.finished_worker = id(worker)
+        st.rerun()
+    finished_at = datetime.fromtimestamp(worker.finished_at).strftime('%H:%M:%S')
+    if worker.status == 'failed':
+        st.error(f"Fetch failed at {finished_at}: {worker.error}")
+    elif worker.status == 'cancelled':
+        st.info(f"Fetch cancelled at {finished_at}.")
+    elif results is None or results['comparison'] is None:
+        st.warning("No data available for comparison")
     else:
-        print(f"Failed to fetch historical stats for KPI: {kpi_id}, Status Code: {response.status_code}, Response: {response.text}")
-    return pd.DataFrame()
+        st.success(f"Data fetched successfully at {finished_at}!")
+    interval = AUTO_REFRESH_INTERVALS[st.session_state.get('auto_refresh', 'Off')]
+    if interval and worker.status == 'done' and time.time() >= worker.finished_at + interval * 60:
+        start_refresh(st.session_state.refresh_settings, worker.kpi_ids_df, previous=worker)
+        st.rerun()
 
-# Round datetime to the nearest 5-minute bucket
-def round_to_nearest_5min(timestamp):
-    dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-    new_minute = (dt.minute // 5) * 5
-    return dt.replace(minute=new_minute, second=0, microsecond=0)
+# Indices of the points kept by Largest-Triangle-Three-Buckets downsampling of (x, y) to
+# n_out points: the first and last points plus, per bucket, the point forming the largest
+# triangle with the previously kept point and the average of the next bucket
+def lttb_indices(x, y, n_out):
+    n = len(x)
+    if n_out is None or n <= n_out or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    edges = (np.arange(n_out - 1) * ((n - 2) / (n_out - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    # Averages of every bucket, the last point standing for the bucket after the last one
+    sizes = np.append(np.diff(edges), 1)
+    average_x = np.add.reduceat(x, edges) / sizes
+    average_y = np.add.reduceat(y, edges) / sizes
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_x, next_y = average_x[i + 1], average_y[i + 1]
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        selected[i + 1] = previous
+    return selected
 
+# Downsample a time series to at most max_points with LTTB, dropping points that cannot
+# be plotted; max_points=None keeps every point
+def downsample(x, y, max_points=None):
+    if max_points is None or len(x) <= max_points:
+        return x, y
+    x_values = to_utc(x)
+    plottable = x_values.notna().to_numpy() & np.isfinite(y.to_numpy(dtype='float64', na_value=np.nan))
+    x, y, x_values = x[plottable], y[plottable], x_values[plottable]
+    keep = lttb_indices(x_values.to_numpy(dtype='datetime64[ns]').view('i8'), y.to_numpy(dtype='float64'), max_points)
+    return x.iloc[keep], y.iloc[keep]
 
-def create_kpi_chart(comparison_data, kpi_name):
-    # Filter data for the selected KPI
-    kpi_data = comparison_data[comparison_data['name'] == kpi_name]
-    
+# Build a line trace, downsampled to max_points, using WebGL above SCATTERGL_THRESHOLD points
+def create_trace(x, y, name, max_points=None):
+    x, y = downsample(x, y, max_points)
+    trace_type = go.Scattergl if len(x) > SCATTERGL_THRESHOLD else go.Scatter
+    return trace_type(x=x, y=y, mode='lines+markers', name=name)
+
+def create_kpi_chart(kpi_data, kpi_name, max_points=None):
     # Create the chart
     fig = go.Figure()
     
     # Add forecasted values
-    fig.add_trace(go.Scatter(
-        x=kpi_data['ForecastedTimestamp'],
-        y=kpi_data['overallResult.value'],
-        mode='lines+markers',
-        name='Forecasted Value'
+    fig.add_trace(create_trace(
+        kpi_data['ForecastedTimestamp'], kpi_data['overallResult.value'], 'Forecasted Value', max_points
     ))
     
     # Add actual values
-    fig.add_trace(go.Scatter(
-        x=kpi_data['ForecastedTimestamp'],
-        y=kpi_data['value'],
-        mode='lines+markers',
-        name='Actual Value'
+    fig.add_trace(create_trace(
+        kpi_data['ForecastedTimestamp'], kpi_data['value'], 'Actual Value', max_points
     ))
     
     # Update layout
@@ -134,32 +302,19 @@ def create_kpi_chart(comparison_data, kpi_name):
     
     return fig
 
-def create_error_metrics_chart(comparison_data, kpi_name):
-    # Filter data for the selected KPI
-    kpi_data = comparison_data[comparison_data['name'] == kpi_name]
-    
+def create_error_metrics_chart(kpi_data, kpi_name, max_points=None):
     # Create the chart with secondary y-axis
     fig = make_subplots(specs=[[{"secondary_y": True}]])
     
     # Add AbsDelta values
     fig.add_trace(
-        go.Scatter(
-            x=kpi_data['ForecastedTimestamp'],
-            y=kpi_data['AbsDelta'],
-            mode='lines+markers',
-            name='Absolute Delta'
-        ),
+        create_trace(kpi_data['ForecastedTimestamp'], kpi_data['AbsDelta'], 'Absolute Delta', max_points),
         secondary_y=False,
     )
     
     # Add ErrorPerc values
     fig.add_trace(
-        go.Scatter(
-            x=kpi_data['ForecastedTimestamp'],
-            y=kpi_data['ErrorPerc'],
-            mode='lines+markers',
-            name='Error Percentage'
-        ),
+        create_trace(kpi_data['ForecastedTimestamp'], kpi_data['ErrorPerc'], 'Error Percentage', max_points),
         secondary_y=True,
     )
     
@@ -176,78 +331,130 @@ def create_error_metrics_chart(comparison_data, kpi_name):
     
     return fig
 
+# KPI evolution and error metrics charts of a KPI at a resolution, built once per
+# publication: the downsampling and the figures are reused by the reruns triggered by
+# other widgets. Past CHART_CACHE_ENTRIES, the charts built first are dropped.
+def kpi_charts(kpi_data, kpi_name, max_points=None):
+    charts = st.session_state.kpi_charts
+    key = (kpi_name, max_points)
+    if key not in charts:
+        with perf_span(st.session_state.perf, "chart.kpi", kpi=kpi_name, rows=len(kpi_data)):
+            fig_kpi = create_kpi_chart(kpi_data, kpi_name, max_points)
+        with perf_span(st.session_state.perf, "chart.error_metrics", kpi=kpi_name, rows=len(kpi_data)):
+            fig_error = create_error_metrics_chart(kpi_data, kpi_name, max_points)
+        charts[key] = (fig_kpi, fig_error)
+        while len(charts) > CHART_CACHE_ENTRIES:
+            del charts[next(iter(charts))]
+    return charts[key]
 
-def calculate_metrics(kpi_data):
-    # Create a copy of the dataframe to avoid SettingWithCopyWarning
-    kpi_data = kpi_data.copy()
-    
-    # Convert 'ForecastedTimestamp' to datetime
-    kpi_data['ForecastedTimestamp'] = pd.to_datetime(kpi_data['ForecastedTimestamp'])
-    
-    # Calculate average values for the entire timeline
-    overall_metrics = {
-        'avg_forecasted': kpi_data['overallResult.value'].mean(),
-        'avg_actual': kpi_data['value'].mean(),
-        'avg_error': kpi_data['ErrorPerc'].mean(),
-    }
-    
-    # Define morning and afternoon periods
-    morning_start = datetime.strptime("06:00", "%H:%M").time()
-    morning_end = datetime.strptime("12:00", "%H:%M").time()
-    afternoon_start = datetime.strptime("12:00", "%H:%M").time()
-    afternoon_end = datetime.strptime("20:00", "%H:%M").time()
-    
-    # Filter data for morning and afternoon
-    morning_mask = (kpi_data['ForecastedTimestamp'].dt.time >= morning_start) & (kpi_data['ForecastedTimestamp'].dt.time < morning_end)
-    afternoon_mask = (kpi_data['ForecastedTimestamp'].dt.time >= afternoon_start) & (kpi_data['ForecastedTimestamp'].dt.time < afternoon_end)
-    
-    morning_data = kpi_data.loc[morning_mask]
-    afternoon_data = kpi_data.loc[afternoon_mask]
-    
-    # Find peak hours
-    if not morning_data.empty:
-        morning_peak = morning_data.loc[morning_data['value'].idxmax()]
-        morning_peak_start = (morning_peak['ForecastedTimestamp'] - timedelta(hours=1))
-        morning_peak_end = (morning_peak['ForecastedTimestamp'] + timedelta(hours=1))
-        morning_peak_mask = (kpi_data['ForecastedTimestamp'] >= morning_peak_start) & (kpi_data['ForecastedTimestamp'] <= morning_peak_end)
-        morning_peak_data = kpi_data.loc[morning_peak_mask]
-        
-        morning_peak_metrics = {
-            'avg_forecasted': morning_peak_data['overallResult.value'].mean(),
-            'avg_actual': morning_peak_data['value'].mean(),
-            'avg_error': morning_peak_data['ErrorPerc'].mean(),
-            'peak_range': f"{morning_peak_start.strftime('%H:%M')} - {morning_peak_end.strftime('%H:%M')}"
-        }
+# Metric value as shown by st.metric, "n/a" when it could not be calculated
+def format_metric(value, suffix=""):
+    if value is None or pd.isna(value):
+        return "n/a"
+    return f"{value:.2f}{suffix}"
+
+# Accuracy metrics shown on the KPI Analysis page, as column of forecast_accuracy() and label
+ACCURACY_METRICS = {'MAPE (%)': 'mape', 'MAE': 'mae', 'Bias': 'bias'}
+
+# Heatmap of an accuracy metric per forecast horizon and hour of day
+def create_accuracy_heatmap(accuracy, metric_label):
+    table = accuracy[ACCURACY_METRICS[metric_label]].unstack('hour')
+    fig = go.Figure(go.Heatmap(
+        x=table.columns, y=[f"{horizon} min" for horizon in table.index], z=table.to_numpy(),
+        colorscale='RdBu_r' if metric_label == 'Bias' else 'Reds', zmid=0 if metric_label == 'Bias' else None,
+        colorbar_title=metric_label
+    ))
+    fig.update_layout(
+        title=f'{metric_label} by Forecast Horizon and Hour of Day (UTC)',
+        xaxis_title='Hour of day targeted',
+        yaxis_title='Forecast horizon',
+        yaxis_type='category'
+    )
+    return fig
+
+# Serialize a frame for download, as CSV or Parquet. The whole file is built in memory,
+# as download buttons send bytes, so only when the button is clicked
+def frame_to_bytes(df, file_format):
+    buffer = io.BytesIO()
+    if file_format == 'Parquet':
+        df.to_parquet(buffer)
     else:
-        morning_peak_metrics = {
-            'avg_forecasted': None,
-            'avg_actual': None,
-            'avg_error': None,
-            'peak_range': "No morning data available"
-        }
-    
-    if not afternoon_data.empty:
-        afternoon_peak = afternoon_data.loc[afternoon_data['value'].idxmax()]
-        afternoon_peak_start = (afternoon_peak['ForecastedTimestamp'] - timedelta(hours=1))
-        afternoon_peak_end = (afternoon_peak['ForecastedTimestamp'] + timedelta(hours=1))
-        afternoon_peak_mask = (kpi_data['ForecastedTimestamp'] >= afternoon_peak_start) & (kpi_data['ForecastedTimestamp'] <= afternoon_peak_end)
-        afternoon_peak_data = kpi_data.loc[afternoon_peak_mask]
-        
-        afternoon_peak_metrics = {
-            'avg_forecasted': afternoon_peak_data['overallResult.value'].mean(),
-            'avg_actual': afternoon_peak_data['value'].mean(),
-            'avg_error': afternoon_peak_data['ErrorPerc'].mean(),
-            'peak_range': f"{afternoon_peak_start.strftime('%H:%M')} - {afternoon_peak_end.strftime('%H:%M')}"
-        }
+        df.to_csv(buffer)
+    return buffer.getvalue()
+
+# Rows of df matching the filter widgets of a table: a range of a numeric column, or a
+# case-insensitive substring of any other column
+def filter_table(df, key):
+    column = st.selectbox("Filter column", ['(none)'] + list(df.columns), key=f"{key}_filter_column")
+    if column == '(none)':
+        return df
+    values = df[column]
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        low, high = values.min(), values.max()
+        if pd.isna(low):
+            return df
+        col_min, col_max = st.columns(2)
+        minimum = col_min.number_input("Min", value=float(low), key=f"{key}_filter_min_{column}")
+        maximum = col_max.number_input("Max", value=float(high), key=f"{key}_filter_max_{column}")
+        return df[values.between(minimum, maximum)]
+    text = st.text_input("Contains", key=f"{key}_filter_text_{column}")
+    if not text:
+        return df
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Match the categories once instead of every row
+        categories = values.cat.categories
+        mask = values.isin(categories[categories.astype(str).str.contains(text, case=False, regex=False)])
     else:
-        afternoon_peak_metrics = {
-            'avg_forecasted': None,
-            'avg_actual': None,
-            'avg_error': None,
-            'peak_range': "No afternoon data available"
-        }
-    
-    return overall_metrics, morning_peak_metrics, afternoon_peak_metrics
+        mask = values.astype(str).str.contains(text, case=False, regex=False)
+    return df[mask]
+
+# Paginated, filterable view of a frame. Only the rows of the current page are sent to
+# the browser; summary statistics and downloads are computed on demand
+def paginated_table(df, key, title=None):
+    if title:
+        st.write(title)
+    if df is None or df.empty:
+        st.write("No rows.")
+        return
+    col_filter, col_size = st.columns([3, 1])
+    with col_filter:
+        filtered = filter_table(df, key)
+    page_size = col_size.selectbox(
+        "Rows per page", TABLE_PAGE_SIZES, index=TABLE_PAGE_SIZES.index(DEFAULT_TABLE_PAGE_SIZE), key=f"{key}_page_size"
+    )
+    n_pages = max(1, -(-len(filtered) // page_size))
+    # Keep the page in range when a filter or the page size shrinks the table
+    if st.session_state.get(f"{key}_page", 1) > n_pages:
+        st.session_state[f"{key}_page"] = n_pages
+    page = col_size.number_input("Page", min_value=1, max_value=n_pages, value=1, step=1, key=f"{key}_page")
+    start = (int(page) - 1) * page_size
+    st.dataframe(filtered.iloc[start:start + page_size])
+    if filtered.empty:
+        st.caption(f"No matching rows (of {len(df):,})")
+    else:
+        st.caption(
+            f"Rows {start + 1:,}-{min(start + page_size, len(filtered)):,} of {len(filtered):,}, page {int(page)} of {n_pages}"
+            + (f" (filtered from {len(df):,})" if len(filtered) != len(df) else "")
+        )
+
+    col_stats, col_format, col_download = st.columns(3)
+    show_stats = col_stats.toggle("Summary statistics", key=f"{key}_stats")
+    file_format = col_format.selectbox(
+        "Download format", ['CSV', 'Parquet'], key=f"{key}_format", label_visibility='collapsed'
+    )
+    # The file is only generated when the button is clicked
+    col_download.download_button(
+        f"Download {len(filtered):,} rows", data=functools.partial(frame_to_bytes, filtered, file_format),
+        file_name=f"{key}.{file_format.lower()}",
+        mime='text/csv' if file_format == 'CSV' else 'application/vnd.apache.parquet',
+        key=f"{key}_download", on_click='ignore', disabled=filtered.empty
+    )
+    if show_stats:
+        numeric = filtered.select_dtypes('number')
+        if numeric.empty:
+            st.write("No numeric columns to summarize.")
+        else:
+            st.dataframe(numeric.describe().T)
 
 
 def main():
@@ -257,6 +464,28 @@ def main():
     st.sidebar.title("Navigation")
     page = st.sidebar.radio("Go to", ('Data Fetch', 'KPI Analysis'))
 
+    # Fetched and computed data is shared between sessions for CACHE_TTL_SECONDS;
+    # invalidating makes this session fetch fresh data on its next refresh
+    if st.sidebar.button("Invalidate cached data"):
+        st.session_state.cache_epoch += 1
+        st.sidebar.info("Cached data will be fetched again on the next refresh.")
+
+    # Background fetch status, polled while a fetch runs or an auto-refresh is pending
+    st.sidebar.subheader("Refresh")
+    auto_refresh = st.sidebar.selectbox(
+        "Auto-refresh", list(AUTO_REFRESH_INTERVALS), key='auto_refresh',
+        help="Fetch again in the background, reusing the KPI definitions; only historical stats newer "
+             "than the local cache are stored"
+    )
+    worker = st.session_state.refresh_worker
+    run_every = None
+    if worker is not None and worker.running:
+        run_every = REFRESH_POLL_SECONDS
+    elif worker is not None and worker.status == 'done' and AUTO_REFRESH_INTERVALS[auto_refresh]:
+        run_every = AUTO_REFRESH_POLL_SECONDS
+    with st.sidebar:
+        st.fragment(refresh_status, run_every=run_every)()
+
     if page == 'Data Fetch':
         st.header("Data Fetch")
         
@@ -267,157 +496,109 @@ def main():
         if api_key_input != st.session_state.api_key:
             st.session_state.api_key = api_key_input
 
+        max_workers = st.number_input(
+            "Max concurrent requests:", min_value=1, max_value=64, value=DEFAULT_MAX_WORKERS, step=1
+        )
+        rate_limit = st.number_input(
+            "Max requests per second:", min_value=1.0, max_value=200.0, value=DEFAULT_RATE_LIMIT, step=1.0
+        )
+        use_cache = st.checkbox("Use local historical stats cache", value=True)
+        retention_days = st.number_input(
+            "Cache retention (days):", min_value=1, max_value=365, value=DEFAULT_CACHE_RETENTION_DAYS, step=1,
+            disabled=not use_cache
+        )
+
         fetch_KPIdef_button = st.button("Fetch KPI definitions and last data")
-        loading_txt = st.empty()
-        loading_txt.text("...")
 
-        # Button to fetch data
+        # Button to fetch data: the KPIs are fetched in the background and shown as they arrive
         if fetch_KPIdef_button:
             if st.session_state.api_key:
+                st.session_state.perf = PerfRecorder()
                 # Fetch data from the API
-                kpi_ids_df = fetch_all_kpis()
+                with perf_span(st.session_state.perf, "load.kpi_definitions"):
+                    kpi_ids_df = fetch_all_kpis()
                 if kpi_ids_df is not None:
                     st.session_state.kpi_ids_df = kpi_ids_df
-                    # Display the data in a table
-                    st.dataframe(kpi_ids_df)
-                    loading_txt.text("Loading last 24 hours data...")
-                    kpi_ids = kpi_ids_df['kpiId']
-                    last_24_hours_data = pd.DataFrame()
-                    for kpi_id in kpi_ids:
-                        loading_txt.text(f"Fetching data for KPI ID: {kpi_id}")
-                        data = fetch_last_24_hours_data(kpi_id)
-                        last_24_hours_data = pd.concat([last_24_hours_data, data], ignore_index=True)
-                    if 'results' in last_24_hours_data.columns:
-                        last_24_hours_data.drop(columns=['results'], inplace=True)
-                    print(f"Columns in last_24_hours_data: {last_24_hours_data.columns.tolist()}")
-                    # Merge to include 'timetostart' in last_24_hours_data
-                    merged_data = last_24_hours_data.merge(kpi_ids_df[['kpiId', 'timetostart']], on='kpiId', how='left')
-                    # Check the merged data
-                    print("Merged DataFrame with 'timetostart':")
-                    print(merged_data.head())
-                    # Now you can use the 'timetostart' in your calculations
-                    # For example, adding 'timetostart' to 'RoundedTimeStamp'
-                    merged_data['ForecastedTimestamp'] = merged_data.apply(
-                        lambda row: row['RoundedTimeStamp'] + timedelta(seconds=row['timetostart']), axis=1
-                    )
-                    last_24_hours_data = merged_data
-                    print("Last 24 hours data head:")
-                    print(last_24_hours_data.head())      
-                    # Display additional data tables
-                    st.write("Last 24 Hours Data:")
-                    st.dataframe(last_24_hours_data)
-                    historical_stats_data = pd.DataFrame()
-                    for kpi_id in kpi_ids:
-                        loading_txt.text(f"Fetching HIST data for KPI ID: {kpi_id}")
-                        data = fetch_historical_stats(kpi_id)
-                        if(data is not None):
-                            historical_stats_data = pd.concat([historical_stats_data, data], ignore_index=True)
-                    
-                    # Display historical stats data
-                    st.write("Historical Stats Data:")
-                    st.dataframe(historical_stats_data)
-
-                    # Step 1: First grouping
-                    intermediateGroupedData = historical_stats_data.groupby(
-                        ['kpiId', 'RoundedTimeStamp', 'progressive']
-                    ).agg(
-                        {
-                            'defaultValue': 'mean',
-                            'value': 'mean',
-                            'averageValue': 'mean',
-                            'unusualValue': 'mean',
-                            'progressive': 'max',
-                            'timeStamp': 'max'
-                        }
-                    )
-
-
-                    # Rename columns to match the original names
-                    intermediateGroupedData = intermediateGroupedData.rename(columns={
-                        'defaultValue': 'defaultValue',
-                        'value': 'value',
-                        'averageValue': 'averageValue',
-                        'unusualValue': 'unusualValue',
-                        'progressive': 'progressive',
-                        'timeStamp': 'timeStamp'
-                    })
-
-                    # Step 2: Second grouping
-                    groupedHistoricalData = intermediateGroupedData.groupby(
-                        ['kpiId', 'RoundedTimeStamp']
-                    ).agg(
-                        {
-                            'defaultValue': 'sum',
-                            'value': 'sum',
-                            'averageValue': 'sum',
-                            'unusualValue': 'sum',
-                            'progressive': 'max',
-                            'timeStamp': 'max'
-                        }
-                    )
-
-                    # Reset index without adding new columns
-                    groupedHistoricalData = groupedHistoricalData.reset_index(drop=False)
-
-                    st.write("Historical Stats Data grouped by 'kpiId', 'RoundedTimeStamp' and averaged on 5 minutes")
-                    st.dataframe(groupedHistoricalData)
-                    loading_txt.empty()  # Remove the loading text
-                    
-                    comparison = None
-                    # Compare quality of forecasted data with historical data
-                    if not last_24_hours_data.empty and not groupedHistoricalData.empty:
-                        print("Comparing forecasted data with historical data...")
-                        # Perform inner join on 'kpiId' and 'ForecastedTimestamp' from merged_data with 'kpiId' and 'RoundedTimeStamp' from groupedHistoricalData
-                        comparison = pd.merge(
-                            last_24_hours_data, 
-                            groupedHistoricalData, 
-                            left_on=['kpiId', 'ForecastedTimestamp', 'overallResult.progressive'], 
-                            right_on=['kpiId', 'RoundedTimeStamp', 'progressive'], 
-                            how='inner'
-                        )
-                        comparison['AbsDelta'] = (comparison['overallResult.value'] - comparison['value']).abs()
-                        comparison['ErrorPerc'] = (comparison['AbsDelta'] / comparison['value']) * 100
-                        # Merge to include 'name' from kpi_ids_df in comparison
-                        comparison = pd.merge(comparison, kpi_ids_df[['kpiId', 'name']], on='kpiId', how='left')
-                        print("Comparison Results:")
-                        print(comparison.head())
-                        st.write("Comparison Results:")
-                        st.dataframe(comparison)
-                        
-                        # Store comparison data in session state
-                        st.session_state.comparison_data = comparison
-                        
-                        st.success("Data fetched successfully!")
-                    else:
-                        warning = "No data available for comparison" 
-                        print(warning)
-                        st.warning(warning)
+                    settings = {
+                        'api_key': st.session_state.api_key,
+                        'max_workers': int(max_workers),
+                        'rate_limit': rate_limit,
+                        'use_cache': use_cache,
+                        'retention_days': int(retention_days),
+                    }
+                    start_refresh(settings, kpi_ids_df)
+                    st.rerun()
             else:
                 st.warning("Please enter an API key.")
+
+        # Display the tables of the last fetch
+        tables = st.session_state.fetched_tables
+        if tables:
+            failed_kpis = tables['failed_kpis']
+            if failed_kpis:
+                st.warning(f"{len(failed_kpis)} KPIs could not be fetched and are missing from the comparison.")
+                st.dataframe(pd.DataFrame({'kpiId': list(failed_kpis), 'error': list(failed_kpis.values())}))
+            paginated_table(tables['kpi_definitions'], 'kpi_definitions', "KPI Definitions:")
+            paginated_table(tables['last_24_hours_data'], 'last_24_hours_data', "Last 24 Hours Data:")
+            paginated_table(tables['historical_stats_data'], 'historical_stats_data', "Historical Stats Data:")
+            paginated_table(
+                tables['grouped_historical_data'], 'grouped_historical_data',
+                "Historical Stats Data grouped by 'kpiId', 'RoundedTimeStamp' and averaged on 5 minutes"
+            )
+            if tables['comparison'] is not None:
+                paginated_table(tables['comparison'], 'comparison', "Comparison Results:")
     elif page == 'KPI Analysis':
         st.header("KPI Analysis")
         
         if st.session_state.comparison_data is not None and st.session_state.kpi_ids_df is not None:
-            # Get unique KPI names
-            kpi_names = st.session_state.kpi_ids_df['name'].unique()
+            kpi_metrics = st.session_state.kpi_metrics
+
+            # Leaderboard of the KPIs with the largest forecast errors across the network
+            st.subheader("Worst Forecast KPIs")
+            error_columns = {
+                'Overall': 'avg_error',
+                'Morning peak': 'morning_avg_error',
+                'Afternoon peak': 'afternoon_avg_error',
+            }
+            col_sort, col_top = st.columns(2)
+            sort_by = col_sort.selectbox("Rank by average error percentage", list(error_columns))
+            top_n = col_top.number_input("Number of KPIs", min_value=1, max_value=max(len(kpi_metrics), 1), value=min(20, max(len(kpi_metrics), 1)))
+            st.dataframe(kpi_metrics.sort_values(error_columns[sort_by], ascending=False).head(int(top_n)))
+
+            # Accuracy of all forecasts per horizon, each matched with the actual of the 5-minute bucket it targets
+            accuracy = st.session_state.forecast_accuracy
+            if accuracy is not None and not accuracy.empty:
+                st.subheader("Accuracy by Forecast Horizon")
+                metric_label = st.selectbox("Accuracy metric", list(ACCURACY_METRICS))
+                with perf_span(st.session_state.perf, "chart.accuracy", rows=len(accuracy)):
+                    fig_accuracy = create_accuracy_heatmap(accuracy, metric_label)
+                st.plotly_chart(fig_accuracy)
+                st.dataframe(st.session_state.horizon_accuracy)
+
+            # Get unique KPI names, of the KPIs loaded so far while a refresh is running
+            comparison_index = st.session_state.comparison_index
+            kpi_names = [name for name in st.session_state.kpi_ids_df['name'].unique() if name in comparison_index]
             
             # Dropdown to select KPI
             selected_kpi = st.selectbox("Select a KPI", kpi_names)
             
-            # Filter data for the selected KPI
-            kpi_data = st.session_state.comparison_data[st.session_state.comparison_data['name'] == selected_kpi]
+            # Slice the data for the selected KPI once; metrics and charts share it
+            kpi_data = get_kpi_data(st.session_state.comparison_data, st.session_state.comparison_index, selected_kpi)
             
-            # Calculate metrics
-            overall_metrics, morning_peak_metrics, afternoon_peak_metrics = calculate_metrics(kpi_data)
+            # Look up the metrics calculated for all KPIs after the fetch
+            if selected_kpi in kpi_metrics.index:
+                overall_metrics, morning_peak_metrics, afternoon_peak_metrics = split_metrics(kpi_metrics.loc[selected_kpi])
+            else:
+                overall_metrics, morning_peak_metrics, afternoon_peak_metrics = calculate_metrics(kpi_data)
             
             # Display overall metric indicators
             st.subheader("Overall KPI Metrics")
             st.write("The following metrics are calculated based on the entire available timeline:")
             
             col1, col2, col3 = st.columns(3)
-            col1.metric("Avg Forecasted Value", f"{overall_metrics['avg_forecasted']:.2f}")
-            col2.metric("Avg Actual Value", f"{overall_metrics['avg_actual']:.2f}")
-            col3.metric("Avg Error Percentage", f"{overall_metrics['avg_error']:.2f}%")
+            col1.metric("Avg Forecasted Value", format_metric(overall_metrics['avg_forecasted']))
+            col2.metric("Avg Actual Value", format_metric(overall_metrics['avg_actual']))
+            col3.metric("Avg Error Percentage", format_metric(overall_metrics['avg_error'], "%"))
             
             # Display peak hour metric indicators
             st.subheader("Peak Hour KPI Metrics")
@@ -426,30 +607,47 @@ def main():
             # Morning peak metrics
             st.write(f"Morning Peak Hours: {morning_peak_metrics['peak_range']}")
             col4, col5, col6 = st.columns(3)
-            col4.metric("Avg Forecasted Value", f"{morning_peak_metrics['avg_forecasted']:.2f}")
-            col5.metric("Avg Actual Value", f"{morning_peak_metrics['avg_actual']:.2f}")
-            col6.metric("Avg Error Percentage", f"{morning_peak_metrics['avg_error']:.2f}%")
+            col4.metric("Avg Forecasted Value", format_metric(morning_peak_metrics['avg_forecasted']))
+            col5.metric("Avg Actual Value", format_metric(morning_peak_metrics['avg_actual']))
+            col6.metric("Avg Error Percentage", format_metric(morning_peak_metrics['avg_error'], "%"))
             
             # Afternoon peak metrics
             st.write(f"Afternoon Peak Hours: {afternoon_peak_metrics['peak_range']}")
             col7, col8, col9 = st.columns(3)
-            col7.metric("Avg Forecasted Value", f"{afternoon_peak_metrics['avg_forecasted']:.2f}")
-            col8.metric("Avg Actual Value", f"{afternoon_peak_metrics['avg_actual']:.2f}")
-            col9.metric("Avg Error Percentage", f"{afternoon_peak_metrics['avg_error']:.2f}%")
+            col7.metric("Avg Forecasted Value", format_metric(afternoon_peak_metrics['avg_forecasted']))
+            col8.metric("Avg Actual Value", format_metric(afternoon_peak_metrics['avg_actual']))
+            col9.metric("Avg Error Percentage", format_metric(afternoon_peak_metrics['avg_error'], "%"))
             
-            # Create and display the KPI evolution chart
-            fig_kpi = create_kpi_chart(st.session_state.comparison_data, selected_kpi)
+            # Downsample long histories before building the chart traces
+            resolution = st.select_slider(
+                "Chart resolution", options=list(CHART_RESOLUTIONS), value=DEFAULT_CHART_RESOLUTION
+            )
+            max_points = CHART_RESOLUTIONS[resolution]
+
+            # Create, or reuse, and display the KPI evolution and error metrics charts
+            fig_kpi, fig_error = kpi_charts(kpi_data, selected_kpi, max_points)
             st.plotly_chart(fig_kpi)
-            
-            # Create and display the error metrics chart
-            fig_error = create_error_metrics_chart(st.session_state.comparison_data, selected_kpi)
             st.plotly_chart(fig_error)
             
             # Display the data table for the selected KPI
             st.subheader(f"Data for {selected_kpi}")
-            st.dataframe(kpi_data)
+            paginated_table(kpi_data, 'kpi_data')
         else:
             st.warning("Please fetch data first on the 'Data Fetch' page.")
 
+    # Timings of the last fetch and of the charts built since, slowest stage first
+    with st.sidebar.expander("Performance", expanded=False):
+        recorder = st.session_state.perf
+        if recorder.spans:
+            st.dataframe(recorder.summary().style.format(
+                {'total_ms': '{:.1f}', 'mean_ms': '{:.1f}', 'max_ms': '{:.1f}', 'rows': '{:,.0f}', 'bytes': '{:,.0f}'}
+            ))
+            st.download_button(
+                "Download spans (OTLP JSON)", recorder.to_json(indent=2),
+                file_name="ptvflows_spans.json", mime="application/json"
+            )
+        else:
+            st.write("No timings recorded yet.")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
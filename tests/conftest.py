@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import ptvflows_pipeline as pipeline
+from helpers import FRAME_TEMPLATE_KPIS, TEST_API_KEY, TEST_HISTORY_HOURS, TEST_KPIS, TEST_RATE_LIMIT, pointed_at
+from ptvflows_synthetic import MockPtvServer, SyntheticKpis
+
+# Shared fixtures: synthetic KPIs served by a local MockPtvServer, with the pipeline
+# pointed at it by mock_api or helpers.pointed_at()
+
+# Start a mock server serving the given SyntheticKpis; every server started is stopped
+# at the end of the module
+@pytest.fixture(scope='module')
+def serve_kpis():
+    servers = []
+
+    def serve(kpis, **options):
+        server = MockPtvServer(kpis, **options).start()
+        servers.append(server)
+        return server
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture(scope='module')
+def synthetic_kpis():
+    return SyntheticKpis(TEST_KPIS, TEST_HISTORY_HOURS)
+
+@pytest.fixture(scope='module')
+def mock_server(serve_kpis, synthetic_kpis):
+    return serve_kpis(synthetic_kpis)
+
+# The mock server of synthetic_kpis, with the pipeline pointed at it during the test
+@pytest.fixture
+def mock_api(mock_server):
+    with pointed_at(mock_server):
+        yield mock_server
+
+# KPI definitions and per-KPI frames fetched once from the mock server
+@pytest.fixture(scope='module')
+def fetched_frames(mock_server):
+    with pointed_at(mock_server):
+        kpi_ids_df = pipeline.fetch_kpi_definitions(TEST_API_KEY)
+        last_24_hours_frames, historical_frames, failed_kpis = pipeline.fetch_all_kpi_data(
+            kpi_ids_df['kpiId'], TEST_API_KEY, rate_limit=TEST_RATE_LIMIT
+        )
+    assert not failed_kpis
+    return kpi_ids_df, last_24_hours_frames, historical_frames
+
+# Results of derive_results() over fetched_frames, as inputs of the later stages
+@pytest.fixture(scope='module')
+def derived(fetched_frames):
+    return pipeline.derive_results(*fetched_frames)
+
+# Per-KPI frames shaped like the results of the fetches, for any number of KPIs without
+# going through the mock server: the payloads of FRAME_TEMPLATE_KPIS synthetic KPIs are
+# parsed once and repeated under new kpiIds. Returns (last 24 hours frames, historical frames),
+# converted by compact_frame() as fetched or, with compact=False, as parsed from the JSON
+@pytest.fixture(scope='module')
+def synthetic_frames():
+    kpis = SyntheticKpis(FRAME_TEMPLATE_KPIS, TEST_HISTORY_HOURS)
+    last_24_hours_templates = []
+    historical_templates = []
+    for kpi_id in kpis.kpi_ids:
+        df = pd.json_normalize(kpis.last_24_hours(kpi_id))
+        df['RoundedTimeStamp'] = pipeline.round_to_nearest_5min(df['timeStamp'])
+        last_24_hours_templates.append(df)
+        df = pd.DataFrame(pipeline.historical_columns(kpis.historical(kpi_id)))
+        df['kpiId'] = kpi_id
+        df['RoundedTimeStamp'] = pipeline.round_to_nearest_5min(df['timeStamp'])
+        historical_templates.append(df)
+
+    compact_templates = (
+        [pipeline.compact_frame(df, drop_columns=['results']) for df in last_24_hours_templates],
+        [pipeline.compact_frame(df) for df in historical_templates],
+    )
+
+    def frames(n_kpis, compact=True):
+        kpi_ids = [f"{i:08d}-0000-4000-8000-000000000000" for i in range(n_kpis)]
+        templates = compact_templates if compact else (last_24_hours_templates, historical_templates)
+
+        def with_kpi_id(df, kpi_id):
+            if compact:
+                kpi_id = pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), categories=[kpi_id])
+            return df.assign(kpiId=kpi_id)
+
+        return tuple(
+            [with_kpi_id(kind[i % FRAME_TEMPLATE_KPIS], kpi_id) for i, kpi_id in enumerate(kpi_ids)]
+            for kind in templates
+        )
+
+    return frames
+
+# Assembled historical stats of at least n_rows rows, as built by assemble_frames: the
+# history of synthetic_frames(100) repeated under new kpiIds
+@pytest.fixture(scope='module')
+def historical_stats_rows(synthetic_frames):
+    _, historical_frames = synthetic_frames(100)
+    base = pipeline.assemble_frames(historical_frames)
+
+    def rows(n_rows):
+        repeats = -(-n_rows // len(base))
+        base_codes = base['kpiId'].cat.codes.to_numpy().astype(np.int64)
+        n_categories = len(base['kpiId'].cat.categories)
+        df = pd.concat([base] * repeats, ignore_index=True)
+        codes = np.concatenate([base_codes + repeat * n_categories for repeat in range(repeats)])
+        kpi_ids = [f"{repeat:04d}-{kpi_id}" for repeat in range(repeats) for kpi_id in base['kpiId'].cat.categories]
+        df['kpiId'] = pd.Categorical.from_codes(codes, categories=kpi_ids)
+        return df
+
+    return rows
@@ -0,0 +1,35 @@
+import tracemalloc
+from contextlib import contextmanager
+
+import ptvflows_pipeline as pipeline
+
+# Constants and helpers shared by conftest.py and the test modules
+
+
+TEST_API_KEY = "test"
+# Size of the synthetic tenant of the default run; the mock server is not throttled
+TEST_KPIS = 50
+TEST_HISTORY_HOURS = 48
+TEST_RATE_LIMIT = 1000.0
+# Distinct synthetic KPIs parsed by synthetic_frames, repeated to reach larger KPI counts
+FRAME_TEMPLATE_KPIS = 5
+
+# Result of function(*args) and the peak memory traced while running it, in bytes
+def peak_memory(function, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+# Point the pipeline at a mock server, restoring the previous API root on exit
+@contextmanager
+def pointed_at(server):
+    api_root = pipeline.API_ROOT
+    pipeline.set_api_root(server.api_root)
+    try:
+        yield server
+    finally:
+        pipeline.set_api_root(api_root)
@@ -0,0 +1,150 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import ptvflows_pipeline as pipeline
+
+# Implementations of the original app that the pipeline replaced, kept as references
+# for the equivalence tests and as baselines of the benchmarks
+
+
+# Build one frame from the per-KPI frames by concatenating them one KPI at a time
+def assemble_frames_concat(frames):
+    df = pd.DataFrame()
+    for data in frames:
+        df = pd.concat([df, data], ignore_index=True)
+    return df
+
+# Round an ISO timestamp down to its 5-minute bucket, one row at a time
+def round_to_nearest_5min_rowwise(timestamp):
+    dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    new_minute = (dt.minute // 5) * 5
+    return dt.replace(minute=new_minute, second=0, microsecond=0)
+
+# Shift every 'RoundedTimeStamp' by the 'timetostart' of its row, one row at a time
+def forecasted_timestamp_rowwise(merged_data):
+    return merged_data.apply(
+        lambda row: row['RoundedTimeStamp'] + timedelta(seconds=row['timetostart']), axis=1
+    )
+
+# Fetch the historical stats of a KPI by parsing the whole response with response.json()
+# and flattening its results into a list of dicts. The timestamps are rounded over the
+# whole column as in the pipeline, so only the parsing differs
+def fetch_historical_stats_json(kpi_id, session):
+    response = session.get(f"{pipeline.KPI_HISTORICAL_URL}?kpiId={kpi_id}")
+    response.raise_for_status()
+    historical_data = []
+    for entry in response.json():
+        if 'timeStamp' in entry and 'results' in entry:
+            timestamp = entry['timeStamp']
+            for result in entry['results']:
+                result['timeStamp'] = timestamp  # Ensure the 'timeStamp' is included in each result
+                result['kpiId'] = kpi_id
+                historical_data.append(result)
+    df = pd.DataFrame(historical_data)
+    df['RoundedTimeStamp'] = pipeline.round_to_nearest_5min(df['timeStamp'])
+    return df
+
+# Group the historical results twice: mean per ('kpiId', 'RoundedTimeStamp',
+# 'progressive'), then sum per ('kpiId', 'RoundedTimeStamp')
+def group_historical_data_two_stage(historical_stats_data):
+    intermediateGroupedData = historical_stats_data.groupby(
+        ['kpiId', 'RoundedTimeStamp', 'progressive'], observed=True
+    ).agg(
+        {
+            'defaultValue': 'mean',
+            'value': 'mean',
+            'averageValue': 'mean',
+            'unusualValue': 'mean',
+            'progressive': 'max',
+            'timeStamp': 'max'
+        }
+    )
+    groupedHistoricalData = intermediateGroupedData.groupby(
+        ['kpiId', 'RoundedTimeStamp'], observed=True
+    ).agg(
+        {
+            'defaultValue': 'sum',
+            'value': 'sum',
+            'averageValue': 'sum',
+            'unusualValue': 'sum',
+            'progressive': 'max',
+            'timeStamp': 'max'
+        }
+    )
+    return groupedHistoricalData.reset_index(drop=False)
+
+
+# Calculate the overall, morning peak and afternoon peak metrics of one KPI, with boolean
+# scans of its rows per period
+def calculate_metrics_per_kpi(kpi_data):
+    # Create a copy of the dataframe to avoid SettingWithCopyWarning
+    kpi_data = kpi_data.copy()
+
+    # Convert 'ForecastedTimestamp' to datetime
+    kpi_data['ForecastedTimestamp'] = pd.to_datetime(kpi_data['ForecastedTimestamp'])
+
+    # Calculate average values for the entire timeline
+    overall_metrics = {
+        'avg_forecasted': kpi_data['overallResult.value'].mean(),
+        'avg_actual': kpi_data['value'].mean(),
+        'avg_error': kpi_data['ErrorPerc'].mean(),
+    }
+
+    # Define morning and afternoon periods
+    morning_start = datetime.strptime("06:00", "%H:%M").time()
+    morning_end = datetime.strptime("12:00", "%H:%M").time()
+    afternoon_start = datetime.strptime("12:00", "%H:%M").time()
+    afternoon_end = datetime.strptime("20:00", "%H:%M").time()
+
+    # Filter data for morning and afternoon
+    morning_mask = (kpi_data['ForecastedTimestamp'].dt.time >= morning_start) & (kpi_data['ForecastedTimestamp'].dt.time < morning_end)
+    afternoon_mask = (kpi_data['ForecastedTimestamp'].dt.time >= afternoon_start) & (kpi_data['ForecastedTimestamp'].dt.time < afternoon_end)
+
+    morning_data = kpi_data.loc[morning_mask]
+    afternoon_data = kpi_data.loc[afternoon_mask]
+
+    # Find peak hours
+    if not morning_data.empty:
+        morning_peak = morning_data.loc[morning_data['value'].idxmax()]
+        morning_peak_start = (morning_peak['ForecastedTimestamp'] - timedelta(hours=1))
+        morning_peak_end = (morning_peak['ForecastedTimestamp'] + timedelta(hours=1))
+        morning_peak_mask = (kpi_data['ForecastedTimestamp'] >= morning_peak_start) & (kpi_data['ForecastedTimestamp'] <= morning_peak_end)
+        morning_peak_data = kpi_data.loc[morning_peak_mask]
+
+        morning_peak_metrics = {
+            'avg_forecasted': morning_peak_data['overallResult.value'].mean(),
+            'avg_actual': morning_peak_data['value'].mean(),
+            'avg_error': morning_peak_data['ErrorPerc'].mean(),
+            'peak_range': f"{morning_peak_start.strftime('%H:%M')} - {morning_peak_end.strftime('%H:%M')}"
+        }
+    else:
+        morning_peak_metrics = {
+            'avg_forecasted': None,
+            'avg_actual': None,
+            'avg_error': None,
+            'peak_range': "No morning data available"
+        }
+
+    if not afternoon_data.empty:
+        afternoon_peak = afternoon_data.loc[afternoon_data['value'].idxmax()]
+        afternoon_peak_start = (afternoon_peak['ForecastedTimestamp'] - timedelta(hours=1))
+        afternoon_peak_end = (afternoon_peak['ForecastedTimestamp'] + timedelta(hours=1))
+        afternoon_peak_mask = (kpi_data['ForecastedTimestamp'] >= afternoon_peak_start) & (kpi_data['ForecastedTimestamp'] <= afternoon_peak_end)
+        afternoon_peak_data = kpi_data.loc[afternoon_peak_mask]
+
+        afternoon_peak_metrics = {
+            'avg_forecasted': afternoon_peak_data['overallResult.value'].mean(),
+            'avg_actual': afternoon_peak_data['value'].mean(),
+            'avg_error': afternoon_peak_data['ErrorPerc'].mean(),
+            'peak_range': f"{afternoon_peak_start.strftime('%H:%M')} - {afternoon_peak_end.strftime('%H:%M')}"
+        }
+    else:
+        afternoon_peak_metrics = {
+            'avg_forecasted': None,
+            'avg_actual': None,
+            'avg_error': None,
+            'peak_range': "No afternoon data available"
+        }
+
+    return overall_metrics, morning_peak_metrics, afternoon_peak_metrics
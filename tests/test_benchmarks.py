@@ -0,0 +1,207 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import ptvflows_pipeline as pipeline
+import streamlit_app as app
+from helpers import TEST_API_KEY, TEST_KPIS, TEST_RATE_LIMIT, peak_memory, pointed_at
+from ptvflows_synthetic import SyntheticKpis
+from reference import (
+    assemble_frames_concat, fetch_historical_stats_json, forecasted_timestamp_rowwise, group_historical_data_two_stage,
+    round_to_nearest_5min_rowwise,
+)
+
+# pytest-benchmark cases timing every stage of the Data Fetch path against the mock
+# server, and the metrics of the KPI Analysis page. Save a run and compare later ones:
+#   python -m pytest tests/test_benchmarks.py --benchmark-only --benchmark-autosave
+#   python -m pytest tests/test_benchmarks.py --benchmark-only --benchmark-compare --benchmark-compare-fail=median:20%
+
+
+def test_fetch_kpi_definitions(benchmark, mock_api):
+    kpi_ids_df = benchmark(pipeline.fetch_kpi_definitions, TEST_API_KEY)
+    assert len(kpi_ids_df) == TEST_KPIS
+
+def test_fetch_all_kpi_data(benchmark, mock_api, synthetic_kpis):
+    last_24_hours_frames, historical_frames, failed_kpis = benchmark.pedantic(
+        pipeline.fetch_all_kpi_data, args=(synthetic_kpis.kpi_ids, TEST_API_KEY),
+        kwargs={'rate_limit': TEST_RATE_LIMIT}, rounds=3
+    )
+    assert not failed_kpis
+    assert all(not df.empty for df in last_24_hours_frames + historical_frames)
+
+# Historical stats served from a warm local cache: only the last 24 hours are fetched
+def test_fetch_all_kpi_data_warm_cache(benchmark, mock_api, synthetic_kpis, tmp_path):
+    cache = pipeline.HistoricalStatsCache(TEST_API_KEY, root=str(tmp_path))
+    pipeline.fetch_all_kpi_data(synthetic_kpis.kpi_ids, TEST_API_KEY, cache=cache, rate_limit=TEST_RATE_LIMIT)
+    _, historical_frames, failed_kpis = benchmark.pedantic(
+        pipeline.fetch_all_kpi_data, args=(synthetic_kpis.kpi_ids, TEST_API_KEY),
+        kwargs={'cache': cache, 'rate_limit': TEST_RATE_LIMIT}, rounds=3
+    )
+    assert not failed_kpis
+    assert all(not df.empty for df in historical_frames)
+
+# Historical stats of one KPI over several history lengths, streamed into column arrays
+# and, as originally, parsed whole with response.json(). The peak memory traced while
+# fetching and its ratio to the memory of the frame built are saved in extra_info.
+@pytest.mark.benchmark(group='fetch_historical')
+@pytest.mark.parametrize('history_hours', [24, 168, 720])
+@pytest.mark.parametrize('fetch', [pipeline.fetch_historical_stats, fetch_historical_stats_json],
+                         ids=['streaming', 'json'])
+def test_fetch_historical_memory(benchmark, serve_kpis, fetch, history_hours):
+    kpis = SyntheticKpis(1, history_hours)
+    kpi_id = kpis.kpi_ids[0]
+    with pointed_at(serve_kpis(kpis)), pipeline.create_session(TEST_API_KEY, 1, TEST_RATE_LIMIT) as session:
+        # The first request makes the server encode and keep the payload
+        fetch(kpi_id, session)
+        df, peak = peak_memory(fetch, kpi_id, session)
+        benchmark.extra_info['rows'] = len(df)
+        benchmark.extra_info['peak_mib'] = round(peak / 2**20, 2)
+        benchmark.extra_info['peak_to_frame'] = round(peak / pipeline.frame_memory(df), 2)
+        benchmark.pedantic(fetch, args=(kpi_id, session), rounds=3)
+
+def test_prepare_last_24_hours_data(benchmark, fetched_frames):
+    kpi_ids_df, last_24_hours_frames, _ = fetched_frames
+    last_24_hours_data = benchmark(pipeline.prepare_last_24_hours_data, last_24_hours_frames, kpi_ids_df)
+    assert last_24_hours_data['ForecastedTimestamp'].notna().all()
+
+def test_assemble_historical(benchmark, fetched_frames):
+    _, _, historical_frames = fetched_frames
+    historical_stats_data = benchmark(pipeline.assemble_frames, historical_frames)
+    assert len(historical_stats_data) == sum(len(df) for df in historical_frames)
+
+# Assembly of the historical frames of 100, 1k and 5k KPIs in one pass, from the frames
+# as fetched, and of the original pd.concat per KPI from the frames as parsed, quadratic
+# in the KPI count and so left out at 5k KPIs. The peak memory traced while assembling,
+# the memory of the frame built and of the per-KPI frames kept are saved in extra_info.
+@pytest.mark.benchmark(group='assemble_frames')
+@pytest.mark.parametrize('assemble, n_kpis', [
+    (pipeline.assemble_frames, 100),
+    (pipeline.assemble_frames, 1000),
+    pytest.param(pipeline.assemble_frames, 5000, marks=pytest.mark.slow),
+    (assemble_frames_concat, 100),
+    pytest.param(assemble_frames_concat, 1000, marks=pytest.mark.slow),
+], ids=['single pass-100', 'single pass-1000', 'single pass-5000', 'concat-100', 'concat-1000'])
+def test_assemble_frames_scaling(benchmark, synthetic_frames, assemble, n_kpis):
+    _, historical_frames = synthetic_frames(n_kpis, compact=assemble is pipeline.assemble_frames)
+    df, peak = peak_memory(assemble, historical_frames)
+    benchmark.extra_info['peak_mib'] = round(peak / 2**20, 1)
+    benchmark.extra_info['frame_mib'] = round(pipeline.frame_memory(df) / 2**20, 1)
+    benchmark.extra_info['kpi_frames_mib'] = round(sum(map(pipeline.frame_memory, historical_frames)) / 2**20, 1)
+    benchmark.pedantic(assemble, args=(historical_frames,), rounds=3)
+    assert len(df) == sum(len(frame) for frame in historical_frames)
+
+# Timestamps of the historical results of 100 KPIs, about 115k rows, as ISO strings
+@pytest.fixture(scope='module')
+def historical_timestamps(synthetic_frames):
+    _, historical_frames = synthetic_frames(100, compact=False)
+    return pd.concat([df['timeStamp'] for df in historical_frames], ignore_index=True)
+
+# Rounding to the 5-minute bucket over whole columns and with the original per-row function
+@pytest.mark.benchmark(group='round_to_5min')
+def test_round_to_nearest_5min_vectorized(benchmark, historical_timestamps):
+    benchmark(pipeline.round_to_nearest_5min, historical_timestamps)
+
+@pytest.mark.benchmark(group='round_to_5min')
+def test_round_to_nearest_5min_rowwise(benchmark, historical_timestamps):
+    benchmark.pedantic(historical_timestamps.apply, args=(round_to_nearest_5min_rowwise,), rounds=3)
+
+@pytest.fixture(scope='module')
+def rounded_timestamps(historical_timestamps):
+    rounded = pipeline.round_to_nearest_5min(historical_timestamps)
+    return pd.DataFrame({'RoundedTimeStamp': rounded, 'timetostart': np.resize([0, 900, 1800, 3600], len(rounded))})
+
+# Forecast times over whole columns and with the original row-wise apply
+@pytest.mark.benchmark(group='forecasted_timestamp')
+def test_compute_forecasted_timestamp_vectorized(benchmark, rounded_timestamps):
+    benchmark(pipeline.compute_forecasted_timestamp, rounded_timestamps['RoundedTimeStamp'],
+              rounded_timestamps['timetostart'])
+
+@pytest.mark.benchmark(group='forecasted_timestamp')
+def test_compute_forecasted_timestamp_rowwise(benchmark, rounded_timestamps):
+    benchmark.pedantic(forecasted_timestamp_rowwise, args=(rounded_timestamps,), rounds=3)
+
+# Grouping of 1M and 10M historical rows in one pass and with the original two-stage groupby
+@pytest.mark.benchmark(group='group_historical')
+@pytest.mark.parametrize('n_rows', [1_000_000, pytest.param(10_000_000, marks=pytest.mark.slow)])
+@pytest.mark.parametrize('group', [pipeline.group_historical_data, group_historical_data_two_stage],
+                         ids=['single pass', 'two-stage'])
+def test_group_historical_data_rows(benchmark, historical_stats_rows, group, n_rows):
+    df = historical_stats_rows(n_rows)
+    grouped = benchmark.pedantic(group, args=(df,), rounds=3)
+    assert len(grouped) * 2 == len(df)
+
+def test_group_historical_data(benchmark, derived):
+    grouped = benchmark(pipeline.group_historical_data, derived['historical_stats_data'])
+    assert len(grouped) == len(derived['grouped_historical_data'])
+
+def test_compare_forecasts(benchmark, fetched_frames, derived):
+    kpi_ids_df = fetched_frames[0]
+    comparison = benchmark(
+        pipeline.compare_forecasts, derived['last_24_hours_data'], derived['grouped_historical_data'],
+        kpi_ids_df[['kpiId', 'name']]
+    )
+    assert len(comparison) == len(derived['comparison'])
+
+def test_project_and_index_comparison(benchmark, fetched_frames, derived):
+    comparison = pipeline.compare_forecasts(
+        derived['last_24_hours_data'], derived['grouped_historical_data'], fetched_frames[0][['kpiId', 'name']]
+    )
+    projected, comparison_index = benchmark(
+        lambda: pipeline.build_comparison_index(pipeline.project_comparison(comparison))
+    )
+    assert len(comparison_index) == TEST_KPIS
+
+def test_calculate_all_metrics(benchmark, derived):
+    metrics = benchmark(pipeline.calculate_all_metrics, derived['comparison'])
+    assert len(metrics) == TEST_KPIS
+
+# Metrics of one KPI at a time, as when the selected KPI has no precomputed metrics
+def test_calculate_metrics(benchmark, derived):
+    comparison, comparison_index = derived['comparison'], derived['comparison_index']
+
+    def calculate_every_kpi():
+        return [pipeline.calculate_metrics(pipeline.get_kpi_data(comparison, comparison_index, kpi_name))
+                for kpi_name in comparison_index]
+
+    metrics = benchmark.pedantic(calculate_every_kpi, rounds=3)
+    assert len(metrics) == TEST_KPIS
+
+def test_forecast_accuracy(benchmark, derived):
+    def match_and_measure():
+        matched = pipeline.match_forecasts_to_actuals(derived['last_24_hours_data'], derived['grouped_historical_data'])
+        return pipeline.forecast_accuracy(matched)
+
+    accuracy = benchmark(match_and_measure)
+    assert accuracy['count'].sum() > 0
+
+# Charts of the KPI Analysis page for one KPI of 20k comparison rows at every chart
+# resolution: time to build the figure and serialize it for the browser, with the size
+# of the serialized figure saved in extra_info
+@pytest.mark.benchmark(group='kpi_chart')
+@pytest.mark.parametrize('resolution', list(app.CHART_RESOLUTIONS))
+def test_kpi_chart_payload(benchmark, resolution):
+    n_points = 20_000
+    kpi_data = pd.DataFrame({
+        'ForecastedTimestamp': pd.date_range('2024-01-01', periods=n_points, freq='5min', tz='UTC'),
+        'overallResult.value': np.sin(np.arange(n_points) / 50).astype('float32'),
+        'value': np.cos(np.arange(n_points) / 50).astype('float32'),
+    })
+    max_points = app.CHART_RESOLUTIONS[resolution]
+
+    def render():
+        return app.create_kpi_chart(kpi_data, 'KPI', max_points).to_json()
+
+    payload = benchmark(render)
+    benchmark.extra_info['payload_kib'] = round(len(payload) / 2**10, 1)
+    assert len(payload) > 0
+
+@pytest.mark.parametrize('use_cache', [False, True], ids=['no cache', 'warm cache'])
+def test_run_pipeline(benchmark, mock_api, tmp_path, use_cache):
+    cache = pipeline.HistoricalStatsCache(TEST_API_KEY, root=str(tmp_path)) if use_cache else None
+    if cache is not None:
+        pipeline.run_pipeline(TEST_API_KEY, rate_limit=TEST_RATE_LIMIT, cache=cache)
+    results = benchmark.pedantic(
+        pipeline.run_pipeline, args=(TEST_API_KEY,), kwargs={'rate_limit': TEST_RATE_LIMIT, 'cache': cache}, rounds=3
+    )
+    assert not results['failed_kpis']
+    assert results['comparison'] is not None
@@ -0,0 +1,387 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+import ptvflows_pipeline as pipeline
+from helpers import TEST_API_KEY, TEST_RATE_LIMIT, peak_memory, pointed_at
+from ptvflows_synthetic import SyntheticKpis
+from reference import (
+    assemble_frames_concat, calculate_metrics_per_kpi, fetch_historical_stats_json, forecasted_timestamp_rowwise,
+    group_historical_data_two_stage, round_to_nearest_5min_rowwise,
+)
+
+# Tests of the pipeline stages, on the synthetic frames of conftest.py or small frames
+# built inline
+
+
+def test_assemble_frames_matches_concat(synthetic_frames):
+    last_24_hours_frames, historical_frames = synthetic_frames(20, compact=False)
+    for frames in (last_24_hours_frames, historical_frames):
+        assembled = pipeline.assemble_frames(frames + [pd.DataFrame(), None])
+        expected = assemble_frames_concat(frames)
+        assert isinstance(assembled['kpiId'].dtype, pd.CategoricalDtype)
+        assert list(assembled['kpiId'].astype(str)) == list(expected['kpiId'])
+        timestamps = pd.to_datetime(expected['timeStamp'], utc=True, format='ISO8601')
+        assert (assembled['timeStamp'] == timestamps).all()
+        for column in pipeline.VALUE_COLUMNS:
+            if column in expected.columns:
+                assert assembled[column].dtype == np.float32
+                np.testing.assert_allclose(assembled[column], expected[column], rtol=1e-6)
+        assert pipeline.frame_memory(assembled) < pipeline.frame_memory(expected)
+
+def test_assemble_frames_drops_columns_and_empty_frames():
+    frame = pd.DataFrame({'kpiId': ['a'], 'timeStamp': ['2024-05-01T10:03:00.000Z'], 'results': [[]]})
+    assembled = pipeline.assemble_frames([pd.DataFrame(), frame], drop_columns=['results', 'missing'])
+    assert list(assembled.columns) == ['kpiId', 'timeStamp']
+    assert pipeline.assemble_frames([pd.DataFrame(), None]).empty
+
+@pytest.mark.parametrize('timestamp, expected', [
+    ('2024-05-01T10:03:30.123Z', '2024-05-01T10:00:00Z'),
+    ('2024-05-01T10:05:00Z', '2024-05-01T10:05:00Z'),
+    ('2024-05-01T23:59:59.999999Z', '2024-05-01T23:55:00Z'),
+    ('2024-05-01T10:04:59.999Z', '2024-05-01T10:00:00Z'),
+    ('2024-05-01T12:03:00+02:00', '2024-05-01T10:00:00Z'),
+    ('2024-05-01T10:58:00+05:45', '2024-05-01T05:10:00Z'),
+    ('2024-05-01T04:01:00-03:30', '2024-05-01T07:30:00Z'),
+], ids=['UTC', 'on the bucket', 'microseconds', 'milliseconds', 'positive offset', 'quarter-hour offset',
+        'negative offset'])
+def test_round_to_nearest_5min(timestamp, expected):
+    rounded = pipeline.round_to_nearest_5min(pd.Series([timestamp]))
+    assert str(rounded.dt.tz) == 'UTC'
+    assert rounded.iloc[0] == pd.Timestamp(expected)
+    assert rounded.iloc[0] == round_to_nearest_5min_rowwise(timestamp)
+
+def test_round_to_nearest_5min_mixed_precision():
+    timestamps = pd.Series(['2024-05-01T10:03:00Z', '2024-05-01T10:08:30.5Z', '2024-05-01T10:12:59.000001+00:00'])
+    rounded = pipeline.round_to_nearest_5min(timestamps)
+    assert list(rounded) == [round_to_nearest_5min_rowwise(timestamp) for timestamp in timestamps]
+
+def test_compute_forecasted_timestamp():
+    rounded = pipeline.round_to_nearest_5min(pd.Series(['2024-05-01T10:03:00Z'] * 4))
+    timetostart = pd.Series([0, 900, None, np.nan], dtype=object)
+    forecasted = pipeline.compute_forecasted_timestamp(rounded, timetostart)
+    assert forecasted.iloc[0] == pd.Timestamp('2024-05-01T10:00:00Z')
+    assert forecasted.iloc[1] == pd.Timestamp('2024-05-01T10:15:00Z')
+    assert forecasted.iloc[2:].isna().all()
+
+# The vectorized rounding and forecast times match the original per-row functions on the
+# forecasts of the synthetic KPIs
+def test_timestamps_match_rowwise(synthetic_frames):
+    last_24_hours_frames, _ = synthetic_frames(5, compact=False)
+    df = pd.concat(last_24_hours_frames, ignore_index=True)
+    rounded = pipeline.round_to_nearest_5min(df['timeStamp'])
+    expected = df['timeStamp'].apply(round_to_nearest_5min_rowwise)
+    assert (rounded == pd.to_datetime(expected, utc=True)).all()
+    merged = pd.DataFrame({'RoundedTimeStamp': rounded, 'timetostart': np.resize([0, 900, 1800, 3600], len(df))})
+    forecasted = pipeline.compute_forecasted_timestamp(merged['RoundedTimeStamp'], merged['timetostart'])
+    assert (forecasted == pd.to_datetime(forecasted_timestamp_rowwise(merged), utc=True)).all()
+
+# Historical stats of one synthetic KPI, as fetched
+@pytest.fixture
+def historical_frame(synthetic_frames):
+    _, historical_frames = synthetic_frames(1)
+    return historical_frames[0]
+
+def test_cache_merge_appends_only_newer_results(tmp_path, historical_frame):
+    cache = pipeline.HistoricalStatsCache("test", root=str(tmp_path))
+    kpi_id = historical_frame['kpiId'].iloc[0]
+    half = len(historical_frame) // 2
+    assert len(cache.merge(kpi_id, historical_frame.iloc[:half])) == half
+    merged = cache.merge(kpi_id, historical_frame)
+    assert len(merged) == len(historical_frame)
+    assert cache.last_timestamp(kpi_id) == pd.to_datetime(historical_frame['timeStamp'], utc=True).max()
+
+# Sessions sharing a tenant merge the same KPI at once: every result is stored once and
+# no temporary file is left behind
+def test_cache_concurrent_merges(tmp_path, historical_frame):
+    kpi_id = historical_frame['kpiId'].iloc[0]
+    chunks = [historical_frame.iloc[:len(historical_frame) * (i + 1) // 8] for i in range(8)] * 4
+    caches = [pipeline.HistoricalStatsCache("test", root=str(tmp_path)) for _ in chunks]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda cache, chunk: cache.merge(kpi_id, chunk), caches, chunks))
+    cached = caches[0].load(kpi_id)
+    assert len(cached) == len(historical_frame)
+    assert not cached.duplicated(['timeStamp', 'progressive']).any()
+    kpi_dir = caches[0]._kpi_dir(kpi_id)
+    assert not [name for name in os.listdir(kpi_dir) if name.endswith('.tmp')]
+
+# The streamed historical stats equal those parsed whole, with a lower peak memory
+def test_fetch_historical_streaming_matches_json(serve_kpis):
+    kpis = SyntheticKpis(1, 720)
+    kpi_id = kpis.kpi_ids[0]
+    with pointed_at(serve_kpis(kpis)), pipeline.create_session(TEST_API_KEY, 1) as session:
+        expected, json_peak = peak_memory(fetch_historical_stats_json, kpi_id, session)
+        streamed, streaming_peak = peak_memory(pipeline.fetch_historical_stats, kpi_id, session)
+    pd.testing.assert_frame_equal(streamed[expected.columns], pipeline.compact_frame(expected))
+    if pipeline.ijson is not None:
+        assert streaming_peak < json_peak
+
+# A stalled server makes requests time out, at the session timeout unless a request sets
+# its own, instead of hanging
+def test_session_timeout(serve_kpis):
+    with pointed_at(serve_kpis(SyntheticKpis(1), latency=0.5)):
+        with pipeline.create_session(TEST_API_KEY, 1) as session:
+            assert session.timeout == pipeline.REQUEST_TIMEOUT_SECONDS
+            session.max_retries, session.timeout = 0, 0.1
+            with pytest.raises(requests.Timeout):
+                session.get(pipeline.KPI_ENG_URL)
+            assert session.get(pipeline.KPI_ENG_URL, timeout=5).status_code == 200
+
+# The burst never lets out more requests than the rate allows in one second
+@pytest.mark.parametrize('rate_limit, max_workers, burst', [
+    (1.0, 64, 1), (0.5, 16, 1), (10.0, 64, 10), (1000.0, 64, 64), (1000.0, 4, pipeline.DEFAULT_RATE_BURST),
+])
+def test_session_burst(rate_limit, max_workers, burst):
+    with pipeline.create_session(TEST_API_KEY, max_workers, rate_limit) as session:
+        assert session.rate_limiter.burst == burst
+
+class RetryAfterResponse:
+    def __init__(self, retry_after):
+        self.headers = {} if retry_after is None else {'Retry-After': retry_after}
+
+@pytest.mark.parametrize('retry_after, delay', [
+    (None, None), ('', None), ('2.5', 2.5), ('-1', 0.0), ('1e6', pipeline.RETRY_AFTER_MAX_SECONDS),
+    ('Mon, 01 Jan 2024 00:00:00 GMT', 0.0), ('soon', None),
+])
+def test_retry_after_delay(retry_after, delay):
+    assert pipeline.retry_after_delay(RetryAfterResponse(retry_after)) == delay
+
+def test_retry_after_delay_http_date():
+    retry_at = pd.Timestamp.now(tz='UTC') + pd.Timedelta(seconds=30)
+    delay = pipeline.retry_after_delay(RetryAfterResponse(retry_at.strftime('%a, %d %b %Y %H:%M:%S GMT')))
+    assert 25 <= delay <= 30
+
+@pytest.mark.parametrize('attempt', [0, 3, 20])
+def test_backoff_delay(attempt):
+    delays = [pipeline.backoff_delay(attempt) for _ in range(100)]
+    max_delay = min(pipeline.BACKOFF_MAX_SECONDS, pipeline.BACKOFF_BASE_SECONDS * 2 ** attempt)
+    assert 0 <= min(delays) and max(delays) <= max_delay
+
+# Fetch every KPI of kpis from a mock server failing fail_rate of the requests, with
+# short backoffs. Returns the fetched frames and failed KPIs
+def fetch_failing(serve_kpis, monkeypatch, kpis, fail_rate):
+    monkeypatch.setattr(pipeline, 'BACKOFF_BASE_SECONDS', 0.01)
+    with pointed_at(serve_kpis(kpis, fail_rate=fail_rate)):
+        return pipeline.fetch_all_kpi_data(kpis.kpi_ids, TEST_API_KEY, rate_limit=TEST_RATE_LIMIT)
+
+# Throttled and unavailable requests are retried until the comparison is complete
+def test_fetch_retries_failed_requests(serve_kpis, monkeypatch, synthetic_kpis, fetched_frames, derived):
+    last_24_hours_frames, historical_frames, failed_kpis = fetch_failing(serve_kpis, monkeypatch, synthetic_kpis, 0.2)
+    assert not failed_kpis
+    results = pipeline.derive_results(fetched_frames[0], last_24_hours_frames, historical_frames)
+    pd.testing.assert_frame_equal(results['comparison'], derived['comparison'])
+
+# KPIs still failing after the retry rounds are reported, with empty frames, and the
+# others are kept
+@pytest.mark.parametrize('fail_rate', [0.9, 1.0])
+def test_fetch_reports_failed_kpis(serve_kpis, monkeypatch, fail_rate):
+    kpis = SyntheticKpis(8)
+    last_24_hours_frames, historical_frames, failed_kpis = fetch_failing(serve_kpis, monkeypatch, kpis, fail_rate)
+    if fail_rate == 1.0:
+        assert set(failed_kpis) == set(kpis.kpi_ids)
+    for kpi_id, last_24_hours, historical in zip(kpis.kpi_ids, last_24_hours_frames, historical_frames):
+        assert (last_24_hours.empty or historical.empty) == (kpi_id in failed_kpis)
+    assert all(error.startswith(('429', '503')) for error in failed_kpis.values())
+
+# Grouped frame in a comparable form: keys as strings, timestamps as UTC datetimes, rows
+# in key order
+def comparable_grouped(grouped):
+    grouped = grouped.assign(
+        kpiId=grouped['kpiId'].astype(str),
+        timeStamp=pd.to_datetime(grouped['timeStamp'], utc=True, format='ISO8601'),
+    )
+    return grouped.sort_values(['kpiId', 'RoundedTimeStamp']).reset_index(drop=True)
+
+def assert_grouped_equal(grouped, expected):
+    pd.testing.assert_frame_equal(
+        comparable_grouped(grouped), comparable_grouped(expected)[grouped.columns], check_dtype=False, rtol=1e-5
+    )
+
+def test_group_historical_data_matches_two_stage(historical_stats_rows):
+    df = historical_stats_rows(50_000)
+    assert_grouped_equal(pipeline.group_historical_data(df), group_historical_data_two_stage(df))
+
+# Missing values are left out of the means; a progressive without any value adds 0 to its bucket
+def test_group_historical_data_missing_values(historical_stats_rows):
+    df = historical_stats_rows(20_000)
+    rng = np.random.default_rng(0)
+    for column in pipeline.HIST_VALUE_COLUMNS:
+        df.loc[rng.random(len(df)) < 0.2, column] = np.nan
+    df.loc[:99, 'value'] = np.nan
+    assert_grouped_equal(pipeline.group_historical_data(df), group_historical_data_two_stage(df))
+
+# Shuffled rows, string kpiIds and ISO timeStamp strings, as before assemble_frames
+def test_group_historical_data_unassembled(synthetic_frames):
+    _, historical_frames = synthetic_frames(3, compact=False)
+    df = pd.concat(historical_frames, ignore_index=True).sample(frac=1, random_state=0)
+    grouped = pipeline.group_historical_data(df)
+    expected_columns = ['kpiId', 'RoundedTimeStamp'] + pipeline.HIST_VALUE_COLUMNS + ['progressive', 'timeStamp']
+    assert list(grouped.columns) == expected_columns
+    assert_grouped_equal(grouped, group_historical_data_two_stage(df))
+
+# Several results per progressive and bucket, and KPIs with disjoint histories, whose keys
+# are too sparse to be counted directly
+def test_group_historical_data_duplicates_and_sparse_keys(historical_stats_rows):
+    df = historical_stats_rows(12_000)
+    kpi_days = pd.to_timedelta(df['kpiId'].cat.codes.astype('int64') * 3, unit='D')
+    df['RoundedTimeStamp'] += kpi_days
+    df['timeStamp'] += kpi_days
+    duplicates = df.assign(value=df['value'] * 3, progressive=df['progressive'].where(df.index % 7 > 0, 5))
+    df = pd.concat([df, duplicates], ignore_index=True)
+    n_keys = df['kpiId'].nunique() * df['RoundedTimeStamp'].nunique() * df['progressive'].nunique()
+    assert n_keys > pipeline.DENSE_KEYS_PER_ROW * len(df)
+    assert_grouped_equal(pipeline.group_historical_data(df), group_historical_data_two_stage(df))
+
+def test_group_historical_data_empty():
+    grouped = pipeline.group_historical_data(pd.DataFrame())
+    assert grouped.empty
+    assert 'value' in grouped.columns
+
+# Forecasts targeting late in a 5-minute bucket are matched with the actual of that
+# bucket, not with the next one that is nearer to the target time
+@pytest.mark.parametrize('timestamp, timetostart, expected', [
+    ('2024-01-01T10:00:00Z', 0, 100.0),
+    ('2024-01-01T10:03:30Z', 0, 100.0),
+    ('2024-01-01T10:04:59.999Z', 0, 100.0),
+    ('2024-01-01T10:05:00Z', 0, 500.0),
+    ('2024-01-01T09:48:30Z', 900, 100.0),
+])
+def test_match_forecasts_to_actuals_bucket(timestamp, timetostart, expected):
+    forecasts = pd.DataFrame({
+        'kpiId': ['kpi'], 'timeStamp': [timestamp], 'timetostart': [timetostart],
+        'overallResult.value': [1.0], 'overallResult.progressive': [0],
+    })
+    actuals = pd.DataFrame({
+        'kpiId': ['kpi', 'kpi'],
+        'RoundedTimeStamp': pd.to_datetime(['2024-01-01T10:00:00Z', '2024-01-01T10:05:00Z']),
+        'progressive': [0, 0], 'value': [100.0, 500.0],
+    })
+    matched = pipeline.match_forecasts_to_actuals(forecasts, actuals)
+    assert len(matched) == 1
+    assert matched['actual'].iloc[0] == expected
+    assert matched['TargetTimestamp'].iloc[0] == matched['ActualTimestamp'].iloc[0]
+
+def test_match_forecasts_to_actuals_missing_bucket():
+    forecasts = pd.DataFrame({
+        'kpiId': ['kpi'], 'timeStamp': ['2024-01-01T10:13:30Z'], 'timetostart': [0],
+        'overallResult.value': [1.0], 'overallResult.progressive': [0],
+    })
+    actuals = pd.DataFrame({
+        'kpiId': ['kpi'], 'RoundedTimeStamp': pd.to_datetime(['2024-01-01T10:00:00Z']),
+        'progressive': [0], 'value': [100.0],
+    })
+    assert pipeline.match_forecasts_to_actuals(forecasts, actuals).empty
+
+# Partial publications are timed as one span each and the stages only for the final one,
+# which goes through derive_final, keyed by the loaded KPIs, and is copied before the
+# worker adds to it
+def test_refresh_worker_spans_and_final_derivation(mock_api):
+    recorder = pipeline.PerfRecorder()
+    shared = []
+
+    def derive_final(derive, kpi_set):
+        assert kpi_set == pipeline.kpi_set_key(mock_api.kpis.kpi_ids)
+        shared.append(derive())
+        return shared[-1]
+
+    worker = pipeline.RefreshWorker(
+        TEST_API_KEY, recorder=recorder, rate_limit=TEST_RATE_LIMIT, publish_interval=0.2, derive_final=derive_final
+    ).start()
+    worker._thread.join(timeout=60)
+    assert worker.status == 'done'
+    names = [span.name for span in recorder.spans]
+    assert names.count('derive.partial') >= 1
+    assert names.count('group.historical') == 1
+    assert len(shared) == 1
+    _, results = worker.snapshot()
+    assert results['loaded_kpis'] == len(worker.kpi_ids_df)
+    assert results is not shared[0] and 'loaded_kpis' not in shared[0]
+    assert results['comparison'] is shared[0]['comparison']
+
+# The final results of a fetch that lost KPIs are derived by the worker alone, so they are
+# never shared with a later complete fetch
+def test_refresh_worker_does_not_share_failed_fetches(mock_api, monkeypatch):
+    monkeypatch.setattr(pipeline, 'BACKOFF_BASE_SECONDS', 0.01)
+    failing_kpi_id = mock_api.kpis.kpi_ids[0]
+
+    def fetch_last_24_hours(kpi_id, session):
+        if kpi_id == failing_kpi_id:
+            raise requests.ConnectionError("dropped")
+        return pipeline.fetch_last_24_hours_data(kpi_id, session)
+
+    def derive_final(derive, kpi_set):
+        raise AssertionError("results of a fetch with failed KPIs were shared")
+
+    worker = pipeline.RefreshWorker(
+        TEST_API_KEY, rate_limit=TEST_RATE_LIMIT, fetch_last_24_hours=fetch_last_24_hours, derive_final=derive_final
+    ).start()
+    worker._thread.join(timeout=60)
+    assert worker.status == 'done'
+    _, results = worker.snapshot()
+    assert list(results['failed_kpis']) == [failing_kpi_id]
+    assert results['loaded_kpis'] == len(worker.kpi_ids_df) - 1
+
+def test_kpi_set_key():
+    assert pipeline.kpi_set_key(['b', 'a']) == pipeline.kpi_set_key(['a', 'b'])
+    assert pipeline.kpi_set_key(['a', 'b']) != pipeline.kpi_set_key(['a'])
+
+# The comparison is projected on COMPARISON_SCHEMA, with compact dtypes and the same values
+def test_project_comparison(fetched_frames, derived):
+    comparison = pipeline.compare_forecasts(
+        derived['last_24_hours_data'], derived['grouped_historical_data'], fetched_frames[0][['kpiId', 'name']]
+    )
+    projected = pipeline.project_comparison(comparison)
+    assert list(projected.columns) == list(pipeline.COMPARISON_SCHEMA)
+    for column in ['kpiId', 'name']:
+        assert isinstance(projected[column].dtype, pd.CategoricalDtype)
+    assert projected['progressive'].dtype == np.int8
+    for column in ['overallResult.value', 'value', 'AbsDelta', 'ErrorPerc']:
+        assert projected[column].dtype == np.float32
+        np.testing.assert_allclose(projected[column], comparison[column], rtol=1e-6)
+    assert projected['ForecastedTimestamp'].dtype == comparison['ForecastedTimestamp'].dtype
+    assert (projected['progressive'] == comparison['progressive']).all()
+    assert pipeline.frame_memory(projected) < pipeline.frame_memory(comparison) / 2
+    assert (derived['comparison'].dtypes == projected.dtypes).all()
+    assert derived['report'] is None
+
+# The CLI exports the comparison on REPORT_SCHEMA, keeping the forecast and history times,
+# the timetostart and the unit, in the order of the comparison kept for analysis
+def test_export_tenant_report(mock_api, tmp_path, derived):
+    written = pipeline.export_tenant(TEST_API_KEY, str(tmp_path), use_cache=False, rate_limit=TEST_RATE_LIMIT)
+    path = next(path for path in written if os.path.basename(path) == 'comparison.parquet')
+    report = pd.read_parquet(path)
+    assert list(report.columns) == list(pipeline.REPORT_SCHEMA)
+    assert report[['timeStamp', 'RoundedTimeStamp', 'timetostart', 'overallResult.unit']].notna().all().all()
+    assert (report['RoundedTimeStamp'] <= report['ForecastedTimestamp']).all()
+    comparison = derived['comparison']
+    for column in comparison.columns:
+        np.testing.assert_array_equal(report[column].astype(comparison[column].dtype), comparison[column])
+
+# The metrics of all KPIs at once match the original per-KPI function, with some actual
+# values missing and KPIs without morning or afternoon rows
+def test_calculate_all_metrics_matches_per_kpi(derived):
+    comparison = derived['comparison'].copy()
+    names = list(derived['comparison_index'])
+    hours = comparison['ForecastedTimestamp'].dt.hour
+    comparison.loc[comparison.index[::7], ['value', 'ErrorPerc']] = np.nan
+    no_morning = (comparison['name'] == names[0]) & (hours >= 6) & (hours < 12)
+    no_afternoon = (comparison['name'] == names[1]) & (hours >= 12) & (hours < 20)
+    comparison, comparison_index = pipeline.build_comparison_index(comparison[~(no_morning | no_afternoon)])
+    metrics = pipeline.calculate_all_metrics(comparison)
+    for name in names:
+        kpi_data = pipeline.get_kpi_data(comparison, comparison_index, name)
+        expected = calculate_metrics_per_kpi(kpi_data)
+        for result in (pipeline.split_metrics(metrics.loc[name]), pipeline.calculate_metrics(kpi_data)):
+            for period_metrics, expected_metrics in zip(result, expected):
+                assert period_metrics.keys() == expected_metrics.keys()
+                for key, value in expected_metrics.items():
+                    if value is None or isinstance(value, str):
+                        assert period_metrics[key] == value
+                    else:
+                        assert period_metrics[key] == pytest.approx(value, rel=1e-6)
+    assert pipeline.split_metrics(metrics.loc[names[0]])[1]['peak_range'] == "No morning data available"
+    assert pipeline.split_metrics(metrics.loc[names[1]])[2]['peak_range'] == "No afternoon data available"
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import pytest
+
+import streamlit_app as app
+
+
+# A sine wave with a single spike, so the point kept in the bucket of the spike is known
+@pytest.fixture
+def series():
+    x = np.arange(10_000, dtype='float64')
+    y = np.sin(x / 100)
+    y[5_003] = 50.0
+    return x, y
+
+@pytest.mark.parametrize('n_out', [3, 10, 500, 2000])
+def test_lttb_keeps_first_and_last_and_n_out(series, n_out):
+    x, y = series
+    keep = app.lttb_indices(x, y, n_out)
+    assert len(keep) == n_out
+    assert keep[0] == 0 and keep[-1] == len(x) - 1
+    assert (np.diff(keep) > 0).all()
+
+def test_lttb_keeps_spike(series):
+    x, y = series
+    assert 5_003 in app.lttb_indices(x, y, 500)
+
+@pytest.mark.parametrize('n_out', [None, 2, 10_000, 20_000])
+def test_lttb_keeps_every_point(series, n_out):
+    x, y = series
+    np.testing.assert_array_equal(app.lttb_indices(x, y, n_out), np.arange(len(x)))
+
+def chart_series(n_points, start='2024-01-01'):
+    x = pd.Series(pd.date_range(start, periods=n_points, freq='5min', tz='UTC'))
+    y = pd.Series(np.sin(np.arange(n_points) / 50), dtype='float32')
+    return x, y
+
+def test_downsample_drops_missing_points():
+    x, y = chart_series(5_000)
+    y.iloc[::7] = np.nan
+    x.iloc[3] = pd.NaT
+    x_out, y_out = app.downsample(x, y, 1_000)
+    assert len(x_out) == 1_000
+    assert x_out.notna().all() and y_out.notna().all()
+    assert x_out.index[0] == 1 and x_out.index[-1] == len(x) - 1
+
+def test_downsample_keeps_short_series():
+    x, y = chart_series(500)
+    y.iloc[0] = np.nan
+    x_out, y_out = app.downsample(x, y, 1_000)
+    assert x_out is x and y_out is y
+
+@pytest.mark.parametrize('n_points, max_points, trace_type', [
+    (app.SCATTERGL_THRESHOLD, None, go.Scatter),
+    (app.SCATTERGL_THRESHOLD + 1, None, go.Scattergl),
+    (5_000, 2_000, go.Scattergl),
+    (5_000, app.SCATTERGL_THRESHOLD, go.Scatter),
+])
+def test_create_trace_type(n_points, max_points, trace_type):
+    x, y = chart_series(n_points)
+    trace = app.create_trace(x, y, 'value', max_points)
+    assert type(trace) is trace_type
+    assert len(trace.x) == min(n_points, max_points or n_points)
+
+# The charts of a KPI and resolution are built once and reused by later reruns, keeping
+# at most CHART_CACHE_ENTRIES of them
+def test_kpi_charts_reused(monkeypatch):
+    monkeypatch.setattr(app.st.session_state, 'kpi_charts', {})
+    x, y = chart_series(5_000)
+    kpi_data = pd.DataFrame({'ForecastedTimestamp': x, 'overallResult.value': y, 'value': y, 'AbsDelta': y, 'ErrorPerc': y})
+    charts = app.kpi_charts(kpi_data, 'KPI', 1_000)
+    assert app.kpi_charts(kpi_data, 'KPI', 1_000) is charts
+    assert app.kpi_charts(kpi_data, 'KPI', 2_000) is not charts
+    for i in range(app.CHART_CACHE_ENTRIES):
+        app.kpi_charts(kpi_data, f'KPI {i}', 1_000)
+    assert len(app.st.session_state.kpi_charts) == app.CHART_CACHE_ENTRIES
+    assert ('KPI', 1_000) not in app.st.session_state.kpi_charts